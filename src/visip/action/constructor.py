@@ -13,7 +13,7 @@ class Value(_ActionBase):
         self.value = value
 
     def action_hash(self):
-        return data.hash(self.value)
+        return data.content_hash(self.value)
 
     def _evaluate(self) -> typing.Any:
         return self.value
@@ -179,4 +179,5 @@ class ClassActionBase(_ActionBase):
         a_hash = data.hash(self.name)
         for param in self.parameters:
             a_hash = data.hash(param.name, previous=a_hash)
-            a_hash = data.hash(param.name, previous=a_hash)
+            a_hash = data.hash(str(param.type), previous=a_hash)
+        return a_hash
@@ -1,13 +1,13 @@
 import os
 import io
 import attr
+import asyncio
 import subprocess
 
 from typing import *
 from ..dev import base, exceptions as exc
 from ..dev import dtype, data
 from ..code import decorators
-from ..dev import tools
 
 # @decorators.Enum
 # class FileMode:
@@ -74,12 +74,33 @@ class SysFile:
 Command = NewType('Command', List[Union[str, FileIn]])
 Redirection = NewType('Redirection', Union[FileOut, None, SysFile])
 
-def _subprocess_handle(redirection):
+def _subprocess_handle(redirection, workdir=''):
     if type(redirection) is str:    # TODO: should be FileOut
-        return open(redirection, "w")
+        return open(os.path.join(workdir, redirection), "w")
     return redirection
 
 
+def _close_handles(*handles):
+    for handle in handles:
+        try:
+            handle.close()
+        except AttributeError:
+            pass
+
+
+def _exec_result(args, return_code, workdir, stdout, stderr):
+    exec_result = ExecResult(
+        args=args,
+        return_code=return_code,
+        workdir=os.path.abspath(workdir),
+        stdout=stdout,
+        stderr=stderr
+    )
+    if exec_result.return_code != 0:
+        exc.ExcVCommandFailed(str(args), exec_result)
+    return exec_result
+
+
 @decorators.action_def
 def system(arguments: Command, stdout: Redirection = None, stderr: Redirection = None, workdir:str = '') -> ExecResult:
     """
@@ -87,34 +108,57 @@ def system(arguments: Command, stdout: Redirection = None, stderr: Redirection =
     The files in the 'arguments' are converted to the file names.
     arguments[0] is the command path.
     Commmand line is composed from the (quoted) arguments separated by the space.
+    The command is executed in the 'workdir', the CWD of the evaluation is not changed,
+    so the commands can run concurrently.
     See: [Subprocess doc](https://docs.python.org/3/library/subprocess.html)
 
     TODO: Some support for piped actions, i.e. when one action produce a sequence of values, we can process them
     in pipline fassin. Here we can treat stdout as a sequence of lines and thus pipe them to other process
     through the POpen piping.
     """
-    with tools.change_cwd(workdir):
-        subprocess.PIPE
-        args = [str(arg) for arg in arguments]
-        stdout = _subprocess_handle(stdout)
-        stderr = _subprocess_handle(stderr)
-        result = subprocess.run(args, stdout=stdout, stderr=stderr)
-        exec_result = ExecResult(
-            args=args,
-            return_code=result.returncode,
-            workdir=os.getcwd(),
-            stdout=result.stdout,
-            stderr=result.stderr
-        )
-        try:
-            stdout.close()
-            stderr.close()
-        except AttributeError:
-            pass
-        if exec_result.return_code != 0:
-            exc.ExcVCommandFailed(str(args), exec_result)
-
-        return exec_result
+    args = [str(arg) for arg in arguments]
+    stdout = _subprocess_handle(stdout, workdir)
+    stderr = _subprocess_handle(stderr, workdir)
+    try:
+        result = subprocess.run(args, stdout=stdout, stderr=stderr, cwd=workdir or None)
+    finally:
+        _close_handles(stdout, stderr)
+    return _exec_result(args, result.returncode, workdir, result.stdout, result.stderr)
+
+
+async def _read_pipe(pipe) -> Optional[bytes]:
+    # Read the whole output of a subprocess pipe without blocking the loop.
+    if pipe is None:
+        return None
+    loop = asyncio.get_event_loop()
+    reader = asyncio.StreamReader(loop=loop)
+    transport, _ = await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader, loop=loop), pipe)
+    try:
+        return await reader.read()
+    finally:
+        transport.close()
+
+
+async def system_async(arguments: Command, stdout: Redirection = None, stderr: Redirection = None, workdir:str = '') -> ExecResult:
+    """
+    Coroutine counterpart of the 'system' action used by the asyncio based resources.
+    Same parameters and result as 'system'.
+    The termination of the process is polled, so the process wide asyncio child watcher
+    is not used and the loop can run in any thread.
+    """
+    args = [str(arg) for arg in arguments]
+    stdout = _subprocess_handle(stdout, workdir)
+    stderr = _subprocess_handle(stderr, workdir)
+    try:
+        process = subprocess.Popen(args, stdout=stdout, stderr=stderr, cwd=workdir or None)
+        out, err = await asyncio.gather(_read_pipe(process.stdout), _read_pipe(process.stderr))
+        delay = 0.001
+        while process.poll() is None:
+            await asyncio.sleep(delay)
+            delay = min(2 * delay, 0.05)
+    finally:
+        _close_handles(stdout, stderr)
+    return _exec_result(args, process.returncode, workdir, out, err)
 
 @decorators.action_def
 def derived_file(f: FileIn, ext:str) -> FileOut:
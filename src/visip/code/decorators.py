@@ -95,16 +95,24 @@ def Enum(enum_cls):
     return int_enum_cls
 
 
-def action_def(func):
+def action_def(func=None, *, version: str = None):
     """
     Decorator to make an action class from the evaluate function.
     Action name is given by the nama of the function.
     Input types are given by the type hints of the function params.
+
+    Usage:
+    @action_def
+    def action(...)
+
+    @action_def(version="2")
+    def action(...)
+
+    The optional 'version' is part of the action hash, change it to invalidate cached results.
     """
-    action_name = func.__name__
-    action = base._ActionBase(action_name)
-    action._evaluate = func
-    action._extract_input_type()
+    if func is None:
+        return lambda f: action_def(f, version=version)
+    action = base._ActionPython(func, version)
     return wrap.public_action(action)
 
 
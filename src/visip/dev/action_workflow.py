@@ -3,6 +3,7 @@ from typing import Any
 
 from . import base
 from . import dfs
+from . import data
 from .action_instance import ActionCall
 from ..action.constructor import _ListBase
 from . parameters import Parameters, ActionParameter
@@ -88,6 +89,9 @@ class _Workflow(base._ActionBase):
     - action_calls can be freely renamed as workflow makes name -> action_call dict only temporally
       (the. name_to_action_call property)
     """
+    _edit_epoch = 0
+    # Incremented by every edit of any workflow. Invalidates memoized hashes of all workflows
+    # as the workflow hash depends on hashes of the called workflows.
 
     def __init__(self, name):
         """
@@ -112,6 +116,9 @@ class _Workflow(base._ActionBase):
         # Dict:  unique action instance name -> action instance.
         self._sorted_calls = []
         # topologically sorted action instance names
+        self._action_hash = None
+        self._hash_epoch = -1
+        # Memoized action hash and the edit epoch of its computation.
 
         self.update_parameters()
 
@@ -150,6 +157,7 @@ class _Workflow(base._ActionBase):
         :param result_instance: the result action
         :return: True in the case of sucessfull update, False - detected cycle
         """
+        _Workflow._edit_epoch += 1
         actions = set()
         topology_sort = []
         instance_names = {}
@@ -199,6 +207,30 @@ class _Workflow(base._ActionBase):
     # def evaluate(self, input):
     #     pass
 
+    def action_hash(self):
+        """
+        Merkle hash of the workflow: hashes of the called actions and the connections
+        of the action calls in the topological order. Independent of the workflow and action call names.
+        Memoized until the next edit of any workflow.
+        """
+        if self._hash_epoch != _Workflow._edit_epoch:
+            self._action_hash = self._merkle_hash()
+            self._hash_epoch = _Workflow._edit_epoch
+        return self._action_hash
+
+    def _merkle_hash(self):
+        w_hash = data.hash(len(self._slots))
+        call_index = {}
+        for i_call, action_call in enumerate(self._sorted_calls):
+            call_index[action_call] = i_call
+            if isinstance(action_call, _SlotCall):
+                call_item = ('slot', self._slots.index(action_call))
+            else:
+                args = [call_index.get(arg.value, None) for arg in action_call.arguments]
+                call_item = (action_call.action.action_hash(), args)
+            w_hash = data.hash(call_item, previous=w_hash)
+        return w_hash
+
 
 
     def dependencies(self):
@@ -386,6 +418,7 @@ class _Workflow(base._ActionBase):
         Update outer interface: parameters and result_type according to slots and result actions.
         TODO: Check and set types.
         """
+        _Workflow._edit_epoch += 1
         self._parameters = Parameters()
         for i_param, slot in enumerate(self._slots):
             slot_expected_types = [a.arguments[i_arg].parameter.type  for a, i_arg in slot.output_actions]
@@ -1,4 +1,6 @@
 import enum
+import types
+from typing import Optional
 from . import data
 from .parameters import Parameters, extract_func_signature
 
@@ -73,7 +75,12 @@ class _ActionBase:
         - hash values of constant parameters
         :return:
         """
-        return data.hash(self.name)
+        # Memoized, but the action can be renamed.
+        name_hash = getattr(self, '_name_hash', None)
+        if name_hash is None or name_hash[0] != self.name:
+            name_hash = (self.name, data.hash(self.name))
+            self._name_hash = name_hash
+        return name_hash[1]
 
 
     def _extract_input_type(self, func=None, skip_self=True) -> None:
@@ -181,6 +188,95 @@ class _ActionBase:
 
 
 
+def code_fingerprint(func: types.FunctionType, _visited=None) -> data.HashValue:
+    """
+    Hash of the Python function implementation independent of the source file position:
+    bytecode, constants (including nested functions), referenced names, default values
+    and values captured by the closure.
+    Referenced globals and closure values that are actions contribute by their action hash, functions
+    from the same module by their fingerprint, other closure values by their data hash.
+    """
+    if _visited is None:
+        _visited = set()
+    _visited.add(func)
+    f_hash = _code_hash(func.__code__)
+    f_hash = data.hash(data.content_hash(func.__defaults__), previous=f_hash)
+    for name in _code_names(func.__code__):
+        obj = func.__globals__.get(name, None)
+        ref_hash = _reference_hash(obj, func, _visited)
+        if ref_hash is not None:
+            f_hash = data.hash((name, ref_hash), previous=f_hash)
+    for name, cell in zip(func.__code__.co_freevars, func.__closure__ or ()):
+        try:
+            obj = cell.cell_contents
+        except ValueError:
+            # Empty cell, the variable is not assigned yet.
+            continue
+        ref_hash = _reference_hash(obj, func, _visited)
+        if ref_hash is None:
+            if isinstance(obj, types.FunctionType):
+                ref_hash = data.hash((obj.__module__, obj.__qualname__))
+            else:
+                ref_hash = data.content_hash(obj)
+        f_hash = data.hash((name, ref_hash), previous=f_hash)
+    return f_hash
+
+
+def _reference_hash(obj, func: types.FunctionType, _visited) -> Optional[data.HashValue]:
+    # Hash of an action or a function from the same module referenced by 'func', None for other objects.
+    action = getattr(obj, 'action', obj)
+    if isinstance(action, _ActionBase):
+        return action.action_hash()
+    if isinstance(obj, types.FunctionType) and obj.__module__ == func.__module__:
+        return code_fingerprint(obj, _visited) if obj not in _visited else data.hash(obj.__qualname__)
+    return None
+
+
+def _code_hash(code: types.CodeType) -> data.HashValue:
+    consts = [_code_hash(c) if isinstance(c, types.CodeType) else c for c in code.co_consts]
+    return data.hash((code.co_code, consts, code.co_names, code.co_argcount, code.co_kwonlyargcount, code.co_flags))
+
+
+def _code_names(code: types.CodeType):
+    # Names used by the code and its nested code objects.
+    yield from code.co_names
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            yield from _code_names(const)
+
+
+class _ActionPython(_ActionBase):
+    """
+    Action implemented by a Python function, see the 'action_def' decorator.
+    The action hash includes the fingerprint of the function code and the explicit version,
+    so the cached results are invalidated by a change of the implementation.
+    """
+    def __init__(self, func: types.FunctionType, version: str = None):
+        super().__init__(func.__name__)
+        self._evaluate = func
+        self.__visip_module__ = func.__module__
+        self.version = version
+        # Explicit version of the implementation, change it to invalidate results
+        # that depend on changes not captured by the code fingerprint (e.g. called libraries).
+        self._code_hash = None
+        self._hashing = False
+        # True during the computation of the hash, recursive references use just the name.
+        self._extract_input_type()
+
+    def action_hash(self):
+        if self._code_hash is None:
+            if self._hashing:
+                return super().action_hash()
+            self._hashing = True
+            try:
+                fingerprint = code_fingerprint(self._evaluate)
+            finally:
+                self._hashing = False
+            self._code_hash = data.hash((self.version, fingerprint), previous=super().action_hash())
+        return self._code_hash
+
+
+
 
 
 
@@ -8,26 +8,49 @@ We SHOULD support:
 
 TODO:
 - use renamed jsondata lib for serialization and deserialization of the VISIP data
-- need support for numpy objects
-- use serialized object for hashing instead of its str repr.
-- use some serious hashing function
 
 Same special dataclasses are implemented, in particular:
 - file wrapper
 - ...
 """
-from typing import NewType
+from typing import NewType, Any, List, Tuple, BinaryIO
+import os
+import io
 import pickle
 import hashlib
+import struct
+import operator
+import enum
+import attr
+import numpy as np
 
 HashValue = NewType('HashValue', int)
 
-default_hash_fn = hash
-def my_hash(x, seed=0):
-    return default_hash_fn((x, seed))
 
-hasher_fn = my_hash
-def hash_stream(stream: bytearray, previous:HashValue=0) -> HashValue:
+class ExcNotHashable(Exception):
+    pass
+
+
+HASH_BYTES = 16
+# 128 bit hashes.
+_HASH_MASK = (1 << (8 * HASH_BYTES)) - 1
+
+
+def _new_hasher(previous: HashValue):
+    hasher = hashlib.blake2b(digest_size=HASH_BYTES)
+    hasher.update((previous & _HASH_MASK).to_bytes(HASH_BYTES, 'little'))
+    return hasher
+
+
+_zero_hasher = _new_hasher(0)
+# Copied for the hashes not chained to a previous hash.
+
+
+def _digest(hasher) -> HashValue:
+    return int.from_bytes(hasher.digest(), 'little')
+
+
+def hash_stream(stream: bytes, previous:HashValue=0) -> HashValue:
     """
     Compute the hash of the bytearray.
     We use fast non-cryptographic hashes long enough to keep probability of collision rate at
@@ -38,10 +61,254 @@ def hash_stream(stream: bytearray, previous:HashValue=0) -> HashValue:
     - input and result hashes
     - ResultsDB
     """
-    return hasher_fn(stream, seed=previous)
+    hasher = _new_hasher(previous)
+    hasher.update(stream)
+    return _digest(hasher)
+
+
+def _type_name(cls):
+    return "{}.{}".format(cls.__module__, cls.__qualname__).encode()
+
+
+_pack_len = struct.Struct('<Q').pack
+_pack_int = struct.Struct('<q').pack
+_pack_float = struct.Struct('<d').pack
+
+_TREE_PROTOCOL = 4
+# Fixed pickle protocol of the hashed streams.
+
+_scalar_types = frozenset([type(None), bool, int, float, str, bytes])
+# Exact types pickled directly into the hashed stream, together with lists and tuples.
+
+
+class _HasherFile:
+    # File like adapter writing into the hasher.
+    __slots__ = ('write',)
+
+    def __init__(self, hasher):
+        self.write = hasher.update
+
+
+class _TreePickler(pickle.Pickler):
+    """
+    Canonical stream of a data tree for the hash. Plain values (scalars, strings, lists, tuples)
+    are pickled in C without the memo, so equal trees give equal streams regardless of the object identities.
+    Other nodes are replaced by the persistent IDs, the digests of their structure given by the '_handlers',
+    e.g. dicts by the sorted items, arrays by their raw buffers.
+    """
+    def __init__(self, hasher):
+        super().__init__(_HasherFile(hasher), protocol=_TREE_PROTOCOL)
+        self.fast = True
+
+    def persistent_id(self, obj):
+        cls = type(obj)
+        if cls in _scalar_types:
+            return None
+        if cls is list or cls is tuple:
+            if len(obj) > 64 and set(map(type, obj)) <= _scalar_types:
+                # Long sequences of scalars at once, without the call for every item.
+                return _node_digest(obj, _update_scalars)
+            return None
+        handler = _handlers.get(cls, None)
+        if handler is None:
+            handler = _find_handler(cls)
+        return _node_digest(obj, handler)
+
+
+def _dump(hasher, data):
+    _TreePickler(hasher).dump(data)
+
+
+def _node_digest(data, handler) -> bytes:
+    hasher = hashlib.blake2b(digest_size=HASH_BYTES)
+    handler(hasher, data)
+    return hasher.digest()
+
+
+def _hash_item(data: Any) -> bytes:
+    hasher = hashlib.blake2b(digest_size=HASH_BYTES)
+    _dump(hasher, data)
+    return hasher.digest()
+
+
+def _update_scalars(hasher, data):
+    hasher.update(b'l' if type(data) is list else b't')
+    pickler = pickle.Pickler(_HasherFile(hasher), protocol=_TREE_PROTOCOL)
+    pickler.fast = True
+    pickler.dump(data)
+
+def _update_plain(tag, convert):
+    # Subclasses of the plain types by the value of the plain type.
+    def update(hasher, data):
+        hasher.update(tag)
+        _dump(hasher, convert(data))
+    return update
+
+_first = operator.itemgetter(0)
+
+def _update_dict(hasher, data):
+    # Independent of the insertion order.
+    try:
+        items = sorted(data.items(), key=_first)
+    except TypeError:
+        # Keys are not comparable, sort by the hashes of the items.
+        hasher.update(b'D')
+        hasher.update(b''.join(sorted(_hash_item(item) for item in data.items())))
+        return
+    hasher.update(b'd')
+    _dump(hasher, items)
+
+def _update_set(hasher, data):
+    hasher.update(b'S')
+    hasher.update(b''.join(sorted(_hash_item(item) for item in data)))
+
+def _update_enum(hasher, data):
+    type_name = _type_name(type(data))
+    hasher.update(b'E' + _pack_len(len(type_name)) + type_name)
+    _dump(hasher, data.value)
+
+def _byte_view(data: np.ndarray) -> np.ndarray:
+    # Bytes of the array in C order as an uint8 array. Unlike the buffer protocol,
+    # works for any dtype (e.g. datetime64) and for the empty arrays.
+    return np.ascontiguousarray(data).reshape(-1).view(np.uint8)
+
+def _update_array(hasher, data):
+    dtype = data.dtype.str.encode()
+    hasher.update(b'a' + _pack_len(len(dtype)) + dtype + _pack_len(data.ndim))
+    hasher.update(b''.join(_pack_len(dim) for dim in data.shape))
+    if data.dtype.hasobject:
+        _dump(hasher, list(data.flat))
+    else:
+        # Raw buffer, no copy for the contiguous arrays.
+        hasher.update(_byte_view(data))
+
+def _update_masked_array(hasher, data):
+    hasher.update(b'm')
+    _update_array(hasher, data.data)
+    _update_array(hasher, np.ma.getmaskarray(data))
+    _dump(hasher, data.fill_value)
+
+def _update_pickled(hasher, data):
+    # Other objects (including array subclasses) by their pickle, i.e. by the state preserved by the result caches.
+    # Unlike str() it does not lose information.
+    type_name = _type_name(type(data))
+    try:
+        stream = pickle.dumps(data, protocol=_TREE_PROTOCOL)
+    except Exception as e:
+        raise ExcNotHashable("Can not hash {} by its content: {}".format(type_name.decode(), e)) from e
+    hasher.update(b'p' + _pack_len(len(type_name)) + type_name)
+    hasher.update(stream)
+
+def _update_np_scalar(hasher, data):
+    dtype = data.dtype.str.encode()
+    hasher.update(b'g' + _pack_len(len(dtype)) + dtype + data.tobytes())
+
+def _update_attrs(hasher, data):
+    type_name = _type_name(type(data))
+    hasher.update(b'A' + _pack_len(len(type_name)) + type_name)
+    _dump(hasher, [(field.name, getattr(data, field.name)) for field in attr.fields(type(data))])
+
+def _update_type(hasher, data):
+    type_name = _type_name(data)
+    hasher.update(b'C' + _pack_len(len(type_name)) + type_name)
+
+_handlers = {
+    dict: _update_dict,
+    np.ndarray: _update_array,
+    np.memmap: _update_array,
+    np.ma.MaskedArray: _update_masked_array,
+}
+# Handlers of the nodes that are not plain by the exact type, other types are resolved by '_find_handler' and added.
+
+
+def _find_handler(cls):
+    if issubclass(cls, enum.Enum):
+        handler = _update_enum
+    elif issubclass(cls, np.generic):
+        # Before the Python types, e.g. float64 is a subclass of float.
+        handler = _update_np_scalar
+    elif issubclass(cls, bool):
+        handler = _update_plain(b'B', bool)
+    elif issubclass(cls, int):
+        handler = _update_plain(b'i', int)
+    elif issubclass(cls, float):
+        handler = _update_plain(b'f', float)
+    elif issubclass(cls, str):
+        handler = _update_plain(b's', str)
+    elif issubclass(cls, (bytes, bytearray, memoryview)):
+        handler = _update_plain(b'b', bytes)
+    elif issubclass(cls, list):
+        handler = _update_plain(b'l', list)
+    elif issubclass(cls, tuple):
+        handler = _update_plain(b't', tuple)
+    elif issubclass(cls, dict):
+        handler = _update_dict
+    elif issubclass(cls, (set, frozenset)):
+        handler = _update_set
+    elif attr.has(cls):
+        handler = _update_attrs
+    elif issubclass(cls, type):
+        handler = _update_type
+    else:
+        # Including the array subclasses, they may carry a state not given by the buffer.
+        handler = _update_pickled
+    _handlers[cls] = handler
+    return handler
+
+
+def _encode_int(data):
+    if -(1 << 63) <= data < (1 << 63):
+        return b'i' + _pack_int(data)
+    n_bytes = (data.bit_length() + 8) // 8
+    return b'I' + _pack_len(n_bytes) + data.to_bytes(n_bytes, 'little', signed=True)
+
+def _encode_str(data):
+    data = data.encode()
+    return b's' + _pack_len(len(data)) + data
+
+_encoders = {
+    type(None): lambda data: b'N',
+    bool: lambda data: b'T' if data else b'F',
+    int: _encode_int,
+    float: lambda data: b'f' + _pack_float(data),
+    str: _encode_str,
+    bytes: lambda data: b'b' + _pack_len(len(data)) + data,
+}
+# Streams of the scalars hashed alone, without the pickler. Distinct from the pickle streams
+# starting by the protocol opcode.
+
 
 def hash(data, previous=0):
-    return hash_stream(str(data), previous)
+    """
+    Structural hash of the data tree, independent of the process (PYTHONHASHSEED) and the machine.
+    Walks lists, tuples, dicts, sets, attrs dataclasses, enums; NumPy arrays are hashed by their raw buffers.
+    Other objects are hashed by their pickle, ExcNotHashable is raised if they can not be pickled.
+    :param previous: Hash chained with the hash of the data.
+    """
+    hasher = _zero_hasher.copy() if previous == 0 else _new_hasher(previous)
+    encode = _encoders.get(type(data), None)
+    if encode is None:
+        _dump(hasher, data)
+    else:
+        hasher.update(encode(data))
+    return _digest(hasher)
+
+
+def content_hash(data, default: HashValue = None) -> HashValue:
+    """
+    Hash of the data, 'default' if the data can not be hashed by its content.
+    Without the default, the hash identifies the object within this process.
+    """
+    try:
+        return hash(data)
+    except ExcNotHashable:
+        if default is not None:
+            return default
+        return hash((_type_name(type(data)), id(data)), previous=_process_salt)
+
+
+_process_salt = int.from_bytes(os.urandom(HASH_BYTES), 'little')
+# Distinguishes the identity hashes of different processes.
 
 
 def hash_file(file_path):
@@ -74,4 +341,72 @@ def deserialize(stream: bytearray):
     :param stream:
     :return:
     """
-    return pickle.loads(stream)
\ No newline at end of file
+    return pickle.loads(stream)
+
+
+OOB_MIN_BYTES = 1 << 16
+# Minimal size of the array stored out of band.
+_BUFFER_ALIGN = 64
+
+
+class _BufferPickler(pickle.Pickler):
+    """
+    Pickler storing the large NumPy arrays out of band, similar to the pickle protocol 5
+    (not available in Python 3.7). Arrays are replaced by the persistent IDs
+    ('ndarray', dtype, shape, offset) referring to the position in the buffer file.
+    """
+    def __init__(self, file, buffers: List[Tuple[int, np.ndarray]]):
+        super().__init__(file, protocol=pickle.HIGHEST_PROTOCOL)
+        self.buffers = buffers
+        self.end = 0
+
+    def persistent_id(self, obj):
+        # Only plain arrays, subclasses (e.g. masked arrays) have a state not given by the buffer.
+        if type(obj) in (np.ndarray, np.memmap) and not obj.dtype.hasobject and obj.nbytes >= OOB_MIN_BYTES:
+            offset = -(-self.end // _BUFFER_ALIGN) * _BUFFER_ALIGN
+            self.buffers.append((offset, obj))
+            self.end = offset + obj.nbytes
+            return ('ndarray', obj.dtype.str, obj.shape, offset)
+        return None
+
+
+class _BufferUnpickler(pickle.Unpickler):
+    def __init__(self, file, buffer_path):
+        super().__init__(file)
+        self.buffer_path = buffer_path
+
+    def persistent_load(self, pid):
+        kind, dtype, shape, offset = pid
+        assert kind == 'ndarray'
+        return np.memmap(self.buffer_path, dtype=np.dtype(dtype), mode='r', offset=offset, shape=shape)
+
+
+def serialize_buffers(data) -> Tuple[bytes, List[Tuple[int, np.ndarray]]]:
+    """
+    Serialize a data tree, large arrays are not copied into the stream.
+    :return: The stream and the list of (offset, array) to be written by 'write_buffers'.
+    """
+    f = io.BytesIO()
+    buffers = []
+    _BufferPickler(f, buffers).dump(data)
+    return f.getvalue(), buffers
+
+
+def write_buffers(buffers: List[Tuple[int, np.ndarray]], f: BinaryIO) -> int:
+    """
+    Write raw array buffers to the file at their aligned offsets.
+    :return: Number of written bytes.
+    """
+    pos = 0
+    for offset, array in buffers:
+        f.write(bytes(offset - pos))
+        f.write(_byte_view(array))
+        pos = offset + array.nbytes
+    return pos
+
+
+def deserialize_buffers(stream: bytes, buffer_path: str):
+    """
+    Deserialize a data tree, arrays stored out of band are memory mapped read only from the 'buffer_path'.
+    """
+    return _BufferUnpickler(io.BytesIO(stream), buffer_path).load()
@@ -11,16 +11,24 @@ Evaluation of a workflow.
 4. Tasks are assigned to the resources by scheduler,
 """
 import os
-from typing import List, Dict, Tuple, Any, Union
+import asyncio
+import threading
+import collections
+import weakref
+import importlib
+from typing import List, Dict, Tuple, Any, Union, Optional
 import attr
 import heapq
 import numpy as np
 import time
+from concurrent import futures
 
 from . import data, task as task_mod, base, dfs,  dtype as dtype, action_instance as instance
+from . import task_arrays
 from .action_workflow import _Workflow
 from ..action.constructor import Value
-from ..eval.cache import ResultCache
+from ..action import std
+from ..eval.cache import ResultCache, LazyValue
 from ..code import wrap
 from ..code.dummy import Dummy
 from . import tools
@@ -34,10 +42,15 @@ class Resource:
 
     We shall start with fixed number of resources, dynamic creation of executing PBS jobs can later be done.
 
+    The base resource evaluates the submitted tasks synchronously, derived resources
+    override '_execute' in order to dispatch the evaluation and report
+    the completed tasks through 'get_finished'.
     """
-    def __init__(self):
+    def __init__(self, cache: ResultCache = None):
         """
         Initialize time scaling and other features of the resource.
+        :param cache: Result cache shared by the evaluations on the resource, in memory ResultCache by default,
+            use DiskResultCache to reuse results of previous runs.
         """
         self.start_latency = 0.0
         # Average time from assignment to actual execution of the task. [seconds]
@@ -50,9 +63,22 @@ class Resource:
         self.n_mpi_proces = 0
         # Maximal number of MPI processes one can assign.
         self._finished = []
-
-
-        self.cache = ResultCache()
+        # Tasks finished since the last call of 'get_finished'.
+        self._ready = []
+        # Tasks that have all inputs finished since the last call of 'get_ready'.
+        self.completion_event = threading.Event()
+        # Set when a running task completes. Replaced by the Scheduler by an event shared by all its resources.
+        self.cache = cache if cache is not None else ResultCache()
+        # Results of the evaluated tasks by the task hash.
+        self._lazy_values = weakref.WeakValueDictionary()
+        # Handles of the cached values used by the tasks, shared by the tasks with the same hash.
+        self._waiting = {}
+        # Maps a task hash leased by another process sharing the cache to the tasks waiting for its result.
+        self.poll_interval = 0.5
+        # Minimal time between checks of the results of the waiting tasks. [seconds]
+        self._last_poll = 0.0
+        self._probed_misses = set()
+        # Hashes of the tasks not found by 'probe_cache', not looked up again until the task is submitted.
 
     # def assign_task(self, task, i_thread=None):
     #     """
@@ -66,45 +92,414 @@ class Resource:
     # def assign_mpi_task(self, task, n_mpi_procs=None):
     #     pass
 
+    @property
+    def n_running(self):
+        """
+        Number of submitted tasks that are not finished yet.
+        """
+        return self.n_waiting
+
+    @property
+    def n_waiting(self):
+        """
+        Number of submitted tasks waiting for the result computed by another process.
+        """
+        return sum(len(tasks) for tasks in self._waiting.values())
+
     def get_finished(self):
         """
         Return list of the tasks finished since the last call.
         :return:
         """
+        self._poll_waiting()
         finished = self._finished
         self._finished = []
         return finished
 
+    def has_free_slot(self):
+        """
+        True if the resource can accept a task for the immediate execution.
+        The waiting tasks do not occupy the slots.
+        """
+        return self.n_running - self.n_waiting < self.n_threads
+
+    def get_ready(self):
+        """
+        Return list of the dependent tasks that became ready due to the tasks finished since the last call.
+        """
+        ready = self._ready
+        self._ready = []
+        return ready
+
+    def close(self):
+        """
+        Release the workers of the resource.
+        """
+        pass
+
     def submit(self, task):
         is_ready = task.is_ready()
         assert task.status >= task_mod.Status.ready
         if is_ready:
-            # hash of action and inputs
-            # TODO: move into task
-            task_hash = task.action_hash()
-            for input in task.inputs:
-                task_hash = data.hash(input.result_hash, previous=task_hash)
+            task_hash = task.task_hash()
+            if task_hash in self._probed_misses:
+                self._probed_misses.discard(task_hash)
+            elif self._finish_cached(task, task_hash):
+                return
+            if self._needs_lease(task) and not self.cache.acquire_lease(task_hash):
+                # Computed by another process, wait for its result.
+                task.status = task_mod.Status.running
+                self._waiting.setdefault(task_hash, []).append(task)
+                return
+            self._execute(task, task_hash)
 
-            # Check result cache
+    @staticmethod
+    def _needs_lease(task) -> bool:
+        # Only the actions given by the Python code are worth to wait for, cheap internal actions
+        # (values, constructors, workflow results) are evaluated without the lease.
+        return isinstance(task.action, base._ActionPython)
 
-            res_value = self.cache.value(task_hash)
-            if res_value is self.cache.NoValue:
-                assert task.is_ready()
-                result = task.evaluate_fn()
-                data_inputs = [input.result for input in task.inputs]
-                res_value = result(data_inputs)
-                # print(task.action)
-                # print(task.inputs)
-                # print(task_hash, res_value)
-                self.cache.insert(task_hash, res_value)
+    def _poll_waiting(self):
+        """
+        Finish the waiting tasks with results stored by other processes meanwhile,
+        evaluate the tasks with lost leases (expired or released without the result).
+        """
+        now = time.perf_counter()
+        if not self._waiting or now < self._last_poll + self.poll_interval:
+            return
+        self._last_poll = now
+        for task_hash in list(self._waiting):
+            if self.cache.result_hash(task_hash) is None and not self.cache.acquire_lease(task_hash):
+                continue
+            for task in self._waiting.pop(task_hash):
+                if not self._finish_cached(task, task_hash):
+                    self._execute(task, task_hash)
+
+    def probe_cache(self, tasks: List[task_mod._TaskBase]) -> List[task_mod._TaskBase]:
+        """
+        Finish the tasks with finished inputs by the cached results, using a single batched query of the cache.
+        Loading of the inputs of the missing atomic tasks starts, these tasks are about to run.
+        :return: The tasks not found in the cache.
+        """
+        hashes = [task.task_hash() for task in tasks]
+        found = self.cache.probe([h for h in hashes if h not in self._probed_misses])
+        missing = []
+        for task, task_hash in zip(tasks, hashes):
+            result_hash = found.get(task_hash, None)
+            if result_hash is not None and self._finish_hit(task, task_hash, result_hash):
+                continue
+            self._probed_misses.add(task_hash)
+            missing.append(task)
+            if not isinstance(task, task_mod.Composed):
+                for input in task.inputs:
+                    input.prefetch_result()
+        return missing
+
+    def _finish_cached(self, task, task_hash):
+        result_hash = self.cache.result_hash(task_hash)
+        if result_hash is None:
+            return False
+        return self._finish_hit(task, task_hash, result_hash)
+
+    def _finish_hit(self, task, task_hash, result_hash):
+        if self.cache.lazy_values:
+            # Only the hash is needed, the value is loaded by the tasks using it.
+            lazy_value = self._lazy_values.get(task_hash, None)
+            if lazy_value is None:
+                lazy_value = self._lazy_values[task_hash] = LazyValue(self.cache, task_hash, result_hash)
+            self._finish(task, task_hash, lazy_value, result_hash)
+            return True
+        res_value = self.cache.value(task_hash, result_hash)
+        if res_value is self.cache.NoValue:
+            return False
+        self._finish(task, task_hash, res_value, result_hash)
+        return True
+
+    def _execute(self, task, task_hash):
+        """
+        Evaluate the task immediately.
+        """
+        start_time = time.perf_counter()
+        try:
+            result = task.evaluate_fn()
+            data_inputs = [input.result for input in task.inputs]
+            res_value = result(data_inputs)
+        except BaseException:
+            # Other processes waiting for the result evaluate the task themselves.
+            self.cache.release_lease(task_hash)
+            raise
+        self._store(task, task_hash, res_value, cost=time.perf_counter() - start_time)
+
+    def _store(self, task, task_hash, res_value, result_hash=None, cost=0.0):
+        """
+        Insert the result of the evaluated task into the cache and finish the task.
+        :param result_hash: Content hash of the result if computed by the worker.
+        :param cost: Evaluation time of the task.
+        """
+        if result_hash is None:
+            if isinstance(task, task_mod.Composed):
+                # Composed task just passes the result of its body.
+                result_hash = task.inputs[0].result_hash
+            else:
+                result_hash = data.content_hash(res_value, task_hash)
+        self.cache.insert(task_hash, res_value, result_hash, cost=cost)
+        self.cache.release_lease(task_hash)
+        self._finish(task, task_hash, res_value, result_hash)
 
-            task.finish(result=res_value, task_hash=task_hash)
-            self._finished.append(task)
+    def _finish(self, task, task_hash, res_value, result_hash):
+        # Tasks with the same hash probed before are found in the cache now.
+        self._probed_misses.discard(task_hash)
+        self._ready.extend(task.finish(result=res_value, task_hash=task_hash, result_hash=result_hash))
+        self._finished.append(task)
 
 
+class _PoolResource(Resource):
+    """
+    Common base of the resources dispatching the evaluation to a pool of workers
+    given by a 'concurrent.futures' executor.
 
+    Only the evaluation of the action runs in the worker, the task status,
+    the result cache and the task DAG are modified only by the thread calling 'submit' and 'get_finished'.
+    """
+    def __init__(self, executor: Optional[futures.Executor], cache: ResultCache = None):
+        super().__init__(cache)
+        self._executor = executor
+        self._running = {}
+        # Maps futures of the running evaluations to the tuples (task, task_hash, submit time).
+        self._done = collections.deque()
+        # Completed futures, appended by the worker threads.
+        self._subscribers = {}
+        # Maps hash of a running task to the tasks with the same hash waiting for its result.
+
+    @property
+    def n_running(self):
+        return len(self._running) + self.n_waiting
+
+    def _execute(self, task, task_hash):
+        subscribers = self._subscribers.get(task_hash, None)
+        if subscribers is not None:
+            # Same task is already running, wait for its result.
+            task.status = task_mod.Status.running
+            subscribers.append(task)
+            return
+        try:
+            future = self._dispatch(task)
+        except BaseException:
+            self.cache.release_lease(task_hash)
+            raise
+        if future is None:
+            super()._execute(task, task_hash)
+        else:
+            task.status = task_mod.Status.running
+            self._running[future] = (task, task_hash, time.perf_counter())
+            self._subscribers[task_hash] = []
+            future.add_done_callback(self._on_done)
+
+    def _on_done(self, future):
+        # Called by the thread completing the future.
+        self._done.append(future)
+        self.completion_event.set()
+
+    def _dispatch(self, task) -> Optional[futures.Future]:
+        """
+        Submit evaluation of the task to the executor.
+        :return: Future of the pair (result value, content hash or None) or None if the task
+            should be evaluated immediately.
+        """
+        assert False, "Not implemented."
+
+    def _future_result(self, future) -> Tuple[Any, Optional[int]]:
+        # Reraise possible exception of the action evaluation.
+        return future.result()
+
+    def get_finished(self):
+        while self._done:
+            future = self._done.popleft()
+            task, task_hash, submit_time = self._running.pop(future)
+            try:
+                res_value, result_hash = self._future_result(future)
+            except BaseException:
+                self.cache.release_lease(task_hash)
+                raise
+            # Tasks are dispatched only to the free workers, so the time from the submission is the evaluation time.
+            self._store(task, task_hash, res_value, result_hash, cost=time.perf_counter() - submit_time)
+            for subscriber in self._subscribers.pop(task_hash):
+                self._finish(subscriber, task_hash, res_value, task.result_hash)
+        return super().get_finished()
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+
+
+class ThreadPoolResource(_PoolResource):
+    """
+    Resource evaluating the tasks by a pool of worker threads.
+    Suitable for the I/O bound and subprocess bound actions (e.g. 'system'),
+    CPU bound Python actions are serialized by the GIL.
+    """
+    def __init__(self, n_threads: int = None, cache: ResultCache = None):
+        """
+        :param n_threads: Number of the worker threads, number of CPUs by default.
+        """
+        n_threads = n_threads or os.cpu_count() or 1
+        super().__init__(futures.ThreadPoolExecutor(max_workers=n_threads), cache)
+        self.n_threads = n_threads
+
+    def _dispatch(self, task):
+        result = task.evaluate_fn()
+        data_inputs = [input.result for input in task.inputs]
+        return self._executor.submit(_evaluate_hashed, result, data_inputs)
+
+
+def _evaluate_hashed(evaluate, data_inputs):
+    # The content hash of the result is computed by the worker as well,
+    # values not hashable by the content get the task hash in '_store'.
+    res_value = evaluate(data_inputs)
+    try:
+        return res_value, data.hash(res_value)
+    except data.ExcNotHashable:
+        return res_value, None
 
 
+def _resolve_action(module_name: str, action_name: str) -> Optional[base._ActionBase]:
+    """
+    Find the action given by its module and name.
+    :return: The action or None if the action is not accessible through the module.
+    """
+    try:
+        module = importlib.import_module(module_name)
+    except ImportError:
+        return None
+    action = getattr(module, action_name, None)
+    if isinstance(action, wrap.ActionWrapper):
+        action = action.action
+    if isinstance(action, base._ActionBase):
+        return action
+    return None
+
+
+def _process_init(modules: List[str]) -> int:
+    """
+    Initialization of a worker process of the ProcessPoolResource, submitted as an ordinary task
+    ('initializer' of the ProcessPoolExecutor is not available before Python 3.7).
+    Modules of the actions not imported here are imported by the first evaluation.
+    """
+    for module_name in modules:
+        importlib.import_module(module_name)
+    return os.getpid()
+
+
+def _process_evaluate(module_name: str, action_name: str, input_stream: bytes) -> Tuple[bytes, int]:
+    """
+    Evaluate an action in a worker process of the ProcessPoolResource.
+    Both inputs and the result are passed serialized, the content hash of the result is computed by the worker.
+    """
+    action = _resolve_action(module_name, action_name)
+    assert action is not None, "Action {}.{} not found.".format(module_name, action_name)
+    inputs = data.deserialize(input_stream)
+    res_value = action.evaluate(inputs)
+    return data.serialize(res_value), data.hash(res_value)
+
+
+class ProcessPoolResource(_PoolResource):
+    """
+    Resource evaluating the tasks by a pool of worker processes.
+    Suitable for the CPU bound Python actions.
+
+    Actions are passed to the workers by the reference: the pair of the module name and the action name,
+    inputs and results are passed serialized. Actions that are not accessible through
+    their module (e.g. Value, internal actions of the workflows) are cheap and evaluated immediately.
+    """
+    def __init__(self, n_workers: int = None, modules: List[str] = (), cache: ResultCache = None):
+        """
+        :param n_workers: Number of the worker processes, number of CPUs by default.
+        :param modules: Modules imported by the workers at startup, typically modules defining the actions.
+        """
+        n_workers = n_workers or os.cpu_count() or 1
+        super().__init__(futures.ProcessPoolExecutor(max_workers=n_workers), cache)
+        self.n_threads = n_workers
+        self._references = {}
+        # Maps id of an action to its reference (module_name, action_name) or None for local actions.
+
+        # Start the workers in advance and import the modules.
+        futures.wait([self._executor.submit(_process_init, list(modules)) for _ in range(n_workers)])
+
+    def action_reference(self, action: base._ActionBase) -> Optional[Tuple[str, str]]:
+        """
+        Return (module_name, action_name) if the 'action' can be resolved by the workers, None otherwise.
+        """
+        key = id(action)
+        if key not in self._references:
+            reference = None
+            if action.task_type == base.TaskType.Atomic:
+                module_name, action_name = action.__visip_module__, action.name
+                if module_name and _resolve_action(module_name, action_name) is action:
+                    reference = (module_name, action_name)
+            self._references[key] = reference
+        return self._references[key]
+
+    def _dispatch(self, task):
+        if isinstance(task, task_mod.Composed):
+            return None
+        reference = self.action_reference(task.action)
+        if reference is None:
+            return None
+        assert task.is_ready()
+        input_stream = data.serialize([input.result for input in task.inputs])
+        return self._executor.submit(_process_evaluate, *reference, input_stream)
+
+    def _future_result(self, future):
+        result_stream, result_hash = future.result()
+        return data.deserialize(result_stream), result_hash
+
+
+async def _limited(semaphore: asyncio.Semaphore, coroutine):
+    async with semaphore:
+        return await coroutine
+
+
+async def _make_semaphore(limit: int) -> asyncio.Semaphore:
+    # Create the semaphore within the running loop, it is bound to it in Python < 3.10.
+    return asyncio.Semaphore(limit)
+
+
+class AsyncSystemResource(_PoolResource):
+    """
+    Resource executing the 'system' tasks as asyncio subprocesses, running
+    in their own working directories. A single background thread runs the event loop
+    for all commands, no thread per a running command is necessary.
+    The resource can be created in any thread, the asyncio child watcher is not used.
+    Other tasks are evaluated immediately.
+    """
+    def __init__(self, max_running: int = 64, cache: ResultCache = None):
+        """
+        :param max_running: Maximal number of concurrently running commands.
+        """
+        super().__init__(executor=None, cache=cache)
+        self.max_running = max_running
+        self.n_threads = max_running
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, daemon=True)
+        self._thread.start()
+        self._semaphore = asyncio.run_coroutine_threadsafe(_make_semaphore(max_running), self._loop).result()
+
+    def _dispatch(self, task):
+        if task.action is not std.system.action:
+            return None
+        assert task.is_ready()
+        data_inputs = [input.result for input in task.inputs]
+        coroutine = _limited(self._semaphore, std.system_async(*data_inputs))
+        return asyncio.run_coroutine_threadsafe(coroutine, self._loop)
+
+    def _future_result(self, future):
+        return future.result(), None
+
+    def close(self):
+        futures.wait(list(self._running))
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+
 
 class Scheduler:
     def __init__(self, resources:Resource):
@@ -113,6 +508,10 @@ class Scheduler:
         """
         self.resources = resources
         # Dict of available resources
+        self._completion_event = threading.Event()
+        # Set by the resources when a running task completes.
+        for resource in self.resources:
+            resource.completion_event = self._completion_event
 
         self.tasks = {}
         # all not yet sumitted tasks, vertices of the DAG that is optimized by the scheduler
@@ -122,86 +521,181 @@ class Scheduler:
         # Priority queue of the 'ready' tasks.  Used to submit the ready tasks without
         # whole DAG optimization. Priority is the
 
-        self._start_time = time.clock()
+        self._start_time = time.perf_counter()
         # Start time of the DAG evaluation.
 
-        self._topology_sort = []
-        # Topological sort of the tasks.
+        self._n_pushed = 0
+        # Number of tasks pushed to the ready queue, breaks ties of the priority in the FIFO manner.
+
+        self._unprobed = []
+        # Ready tasks not looked up in the cache yet.
+
+        self.critical_path = True
+        # Submit ready tasks according to their rank (longest path to the root task).
+        # Tasks are submitted in FIFO order if False.
 
     @property
     def n_assigned_tasks(self):
         return len(self.tasks)
 
+    @property
+    def n_running_tasks(self):
+        return sum(resource.n_running for resource in self.resources)
+
+    @property
+    def n_live_tasks(self):
+        return self.n_assigned_tasks + self.n_running_tasks
+
     def get_time(self):
-        return time.clock() - self._start_time
+        return time.perf_counter() - self._start_time
 
     def append(self, tasks):
         """
         Add more tasks of the same DAG to be scheduled to the resources,
-        :param tasks: All tasks that are new or have changed inputs.
-        :return: List of composed tasks to expand. If empty the optimization should be called.
+        Start times and ranks are updated incrementally, only the new tasks and
+        the predecessors with increased rank are processed.
+        :param tasks: All tasks that are new or have changed inputs. In topological order
+            (as created by the expansion) in order to minimize rank updates.
         """
-        self.tasks.update({ t.id: t for t in tasks})
+        for task in tasks:
+            task.resource_id = 0
+            max_end_time = 0
+            for pre in task.inputs:
+                max_end_time = max(max_end_time, pre.start_time + pre.eval_time)
+            task.start_time = max_end_time
+            self.tasks[task.id] = task
+        if self.critical_path:
+            for task in reversed(tasks):
+                self._raise_rank(task)
+        for task in tasks:
+            self.ready_queue_push(task)
 
-    def ready_queue_push(self, task):
-        if task.is_ready():
-            heapq.heappush(self._ready_queue, task)
+    def _raise_rank(self, task):
+        """
+        Update the rank of the 'task' from the ranks of its outputs and propagate
+        increased ranks to its unfinished predecessors. Ranks never decrease,
+        increased rank of a ready task is pushed again to the ready queue.
+        """
+        rank = task.eval_time + max((out.rank for out in task.outputs), default=0.0)
+        task.rank = max(task.rank, rank)
+        stack = [task]
+        while stack:
+            task = stack.pop()
+            for pre in task.inputs:
+                rank = pre.eval_time + task.rank
+                if rank > pre.rank and not pre.is_finished():
+                    pre.rank = rank
+                    if pre.id in self.tasks:
+                        self.ready_queue_push(pre)
+                    stack.append(pre)
+
+    def probe_cache(self, tasks: List[task_mod._TaskBase]) -> List[task_mod._TaskBase]:
+        """
+        Finish the not yet submitted tasks by the results from the caches of their resources,
+        a single batched query for every resource.
+        :return: The tasks not found in the caches.
+        """
+        by_resource = collections.defaultdict(list)
+        for task in tasks:
+            by_resource[task.resource_id].append(task)
+        missing = []
+        for resource_id, resource_tasks in by_resource.items():
+            missing.extend(self.resources[resource_id].probe_cache(resource_tasks))
+        for task in tasks:
+            if task.is_finished():
+                del self.tasks[task.id]
+        return missing
 
+    def is_idle(self):
+        """
+        True if a resource has a free slot and there is no ready task to submit.
+        """
+        if not any(resource.has_free_slot() for resource in self.resources):
+            return False
+        return all(task.id not in self.tasks for priority, i_push, task in self._ready_queue)
 
+    def ready_queue_push(self, task):
+        if task.is_ready():
+            heapq.heappush(self._ready_queue, (-task.priority, self._n_pushed, task))
+            self._n_pushed += 1
+            self._unprobed.append(task)
 
     def _collect_finished(self):
         # collect finished tasks, update ready queue
         finished = []
         for resource in self.resources:
-            new_finished = resource.get_finished()
-            for task in new_finished:
-                for dep_task in task.outputs:
-                    self.ready_queue_push(dep_task)
-            finished.extend(new_finished)
+            finished.extend(resource.get_finished())
+            for task in resource.get_ready():
+                self.ready_queue_push(task)
         return finished
 
 
+    def wait(self, timeout: float):
+        """
+        Block until a running task completes or 'timeout' seconds pass.
+        Return immediately if there are no running tasks.
+        """
+        if self.n_running_tasks > 0:
+            self._completion_event.wait(timeout)
+
     def update(self):
         """
         Update resources, collect finished tasks, submit new ready tasks.
-        Should be called approximately every 'call_period' seconds.
+        Called after every completion, or every 'timeout' seconds passed to 'wait'.
         """
+        # Completions after this point are reported by the event, earlier are collected now.
+        self._completion_event.clear()
         finished = self._collect_finished()
+        while self._unprobed:
+            # Resolve the cached tasks before the submission, one query per level of the cached DAG.
+            unprobed = list({task.id: task for task in self._unprobed if task.id in self.tasks}.values())
+            self._unprobed = []
+            if len(self.probe_cache(unprobed)) < len(unprobed):
+                finished.extend(self._collect_finished())
         while self._ready_queue:
-            task = heapq.heappop(self._ready_queue)
+            priority, i_push, task = self._ready_queue[0]
             if task.id in self.tasks:   # deal with duplicate entrieas in the queue
-                self.resources[task.resource_id].submit(task)
+                resource = self.resources[task.resource_id]
+                if not resource.has_free_slot():
+                    # Keep the remaining tasks for the resource in the priority queue.
+                    break
+                resource.submit(task)
                 del self.tasks[task.id]
+            heapq.heappop(self._ready_queue)
         return finished
 
     def optimize(self):
         """
-        Perform CPM on the DAG of non-submitted tasks.
-        Assign start_times and priorities according to the slack time.
+        Perform CPM on the whole DAG of non-submitted tasks.
+        Forward pass assigns the earliest start_times, backward pass assigns the ranks, i.e. the longest
+        estimated evaluation time from the start of the task to the end of the root task.
+        Ready tasks are submitted in order of decreasing rank so that the critical path starts first.
         Assume just a single resource.
+
+        Not necessary during the evaluation as 'append' maintains the ranks incrementally,
+        use to recompute ranks after change of the eval time estimates.
         :return:
         """
-        # perform topological sort
-        def predecessors(task):
-            if task.is_finished():
-                return []
-            else:
-                max_end_time = 0
-                for pre in task.inputs:
-                    max_end_time = max(max_end_time, pre.start_time + pre.eval_time)
-                task.start_time = max_end_time
-            return task.inputs
-
+        topology_sort = []
         def post_visit(task):
             task.resource_id = 0
-            self.ready_queue_push(task)
-            self._topology_sort.append(task)
-
+            max_end_time = 0
+            for pre in task.inputs:
+                max_end_time = max(max_end_time, pre.start_time + pre.eval_time)
+            task.start_time = max_end_time
+            topology_sort.append(task)
 
-        dfs.DFS(neighbours=predecessors,
+        dfs.DFS(neighbours=lambda task: [] if task.is_finished() else task.inputs,
                 postvisit=post_visit).run(self.tasks.values())
 
-        #print("N task: ", len(self.tasks))
+        if self.critical_path:
+            for task in reversed(topology_sort):
+                task.rank = task.eval_time + max((out.rank for out in task.outputs), default=0.0)
+
+        # Ranks changed, rebuild the ready queue.
+        self._ready_queue = []
+        for task in topology_sort:
+            self.ready_queue_push(task)
 
 
 
@@ -234,8 +728,8 @@ class Evaluation:
     - perform expansion of composed tasks into the task DAG
     - can evaluate a workflow in interaction with the Scheduler
     - hierarchical view of the execution DAG, tasks are organised to the tree of composed tasks
-      currently all tasks are kept, in future, just a map from the task address in the tree to its input hash would be
-      enough computing results of the micro action on the fly
+      all tasks are kept by default, with 'reclaim' the results consumed by all dependent tasks are dropped
+      and the finished composed tasks are collapsed to the map from the task ID to the task hash
     - grouping of actions into macro actions is done here as the part of the expansion process
 
 
@@ -286,14 +780,31 @@ class Evaluation:
 
 
 
-    def __init__(self, analysis: base._ActionBase):
+    def __init__(self, analysis: base._ActionBase, resources: List[Resource] = None,
+                 eval_time_estimates: Dict[str, float] = None, reclaim: bool = False,
+                 expand_all: bool = False):
         """
         Create object for evaluation of the workflow 'analysis' with no parameters.
         Use 'make_analysis' to substitute arguments to arbitrary action.
 
         :param analysis: an action without inputs
+        :param resources: Resources evaluating the tasks, single synchronous Resource by default.
+        :param eval_time_estimates: Estimated evaluation times of the actions given by name, used to prioritize
+            tasks on the critical path. Default estimate is 1.
+        :param reclaim: Drop the results and finished subtrees during the evaluation, only the result
+            of the final task is kept. Use 'task_result' and 'indexed_result' to get the dropped values
+            from the result cache.
+        :param expand_all: Expand every composed task, their results are not looked up in the cache
+            before the expansion. Used by the interactive evaluation that displays the bodies of the composed tasks.
         """
-        self.resources = [ Resource() ]
+        self.reclaim = reclaim
+        self.expand_all = expand_all
+        self.result_index: Dict[int, int] = {}
+        # Map from the task ID to the task hash (the cache key) for the tasks of the collapsed composed tasks.
+        self.eval_time_estimates = eval_time_estimates or {}
+        if resources is None:
+            resources = [ Resource() ]
+        self.resources = resources
         self.scheduler = Scheduler(self.resources)
 
         self.final_task = task_mod._TaskBase._create_task(None, '__root__', analysis, [])
@@ -302,8 +813,11 @@ class Evaluation:
         # Auxiliary ID of composed tasks to break ties
         self.queue = []
         # Priority queue of the composed tasks to expand. Tasks are expanded until the task DAG is not
-        # complete or number of unresolved tasks is smaller then given limit.
-        self.enqueue(self.final_task)
+        # complete or number of live tasks is smaller then given limit.
+        # Depth first, composed tasks with higher rank first.
+        self.deferred = []
+        # Composed tasks waiting for their inputs. Result of a composed task with finished inputs
+        # is looked up in the cache before the expansion.
 
         self.force_finish = False
         # Used to force end of evaluation after an error.
@@ -313,6 +827,7 @@ class Evaluation:
 
         # init scheduler
         self.tasks_update([self.final_task])
+        self.enqueue(self.final_task)
 
     def tasks_update(self, tasks):
         for t in tasks:
@@ -328,7 +843,48 @@ class Evaluation:
         if task.is_finished():
             task.eval_time = task.end_time - task.start_time
         else:
-            task.time_estimate = 1
+            task.eval_time = self.eval_time_estimates.get(task.action.name, 1.0)
+
+    def reclaim_tasks(self, finished: List[task_mod._TaskBase]):
+        """
+        Drop the results of the inputs of the 'finished' tasks that are consumed by all their outputs,
+        collapse the finished composed tasks.
+        """
+        for task in finished:
+            for input in task.inputs:
+                while isinstance(input, task_mod.ComposedHead):
+                    input = input.inputs[0]
+                input.reclaim_result()
+            if isinstance(task, task_mod.Composed):
+                index = task.collapse()
+                if index is not None:
+                    self.result_index.update(index)
+
+    def task_result(self, task: task_mod._TaskBase) -> dtype.DataType:
+        """
+        Result of the finished task, reclaimed values are loaded from the result cache.
+        """
+        result = task.result
+        if result is task.no_value and task.is_finished():
+            result = self.resources[task.resource_id or 0].cache.value(task.task_hash(), task.result_hash)
+        return result
+
+    def indexed_result(self, task_id: int) -> dtype.DataType:
+        """
+        Result of a task of the collapsed composed tasks given by its ID, loaded from the result cache.
+        """
+        task_hash = self.result_index[task_id]
+        for resource in self.resources:
+            result = resource.cache.value(task_hash)
+            if result is not resource.cache.NoValue:
+                return result
+        return ResultCache.NoValue
+
+    def task_arrays(self) -> task_arrays.TaskArrays:
+        """
+        Snapshot of the current task DAG in NumPy arrays for vectorized queries.
+        """
+        return task_arrays.TaskArrays.collect([self.final_task])
 
     def validate_connections(self, action):
         """
@@ -344,9 +900,13 @@ class Evaluation:
 
     def execute(self, assigned_tasks_limit = np.inf,
                 process_tasks = np.inf,
-                workspace: str = ".") -> task_mod._TaskBase:
+                workspace: str = ".",
+                wait_timeout: float = 1.0) -> task_mod._TaskBase:
         """
         Execute the workflow.
+        The loop blocks while waiting for the running tasks, at most 'wait_timeout' seconds.
+        Expansion of the composed tasks pauses while the number of live (not yet submitted or running) tasks
+        reaches the 'assigned_tasks_limit'.
         :return:
         """
         os.makedirs(workspace, exist_ok=True)
@@ -355,42 +915,89 @@ class Evaluation:
             invalid_connections = self.validate_connections(self.final_task.action)
             if invalid_connections:
                 raise Exception(invalid_connections)
+            stalled = False
             while not self.force_finish:
-                schedule = self.expand_tasks(assigned_tasks_limit)
-                self.tasks_update(schedule)
-                self.scheduler.update()
-                self.scheduler.optimize()
-                if  self.scheduler.n_assigned_tasks == 0:
+                schedule = self.expand_tasks(assigned_tasks_limit, force=stalled)
+                finished = self.scheduler.update()
+                if self.reclaim:
+                    self.reclaim_tasks(finished)
+                stalled = False
+                if  self.scheduler.n_assigned_tasks == 0 and self.scheduler.n_running_tasks == 0:
                     self.force_finish = True
+                elif not schedule and not finished:
+                    if self.scheduler.n_running_tasks == 0:
+                        # Live tasks wait for the unexpanded composed tasks.
+                        stalled = True
+                    else:
+                        # Nothing changed, wait for the running tasks.
+                        self.scheduler.wait(wait_timeout)
         return self.final_task
 
 
 
 
     def enqueue(self, task: task_mod.Composed):
-        heapq.heappush(self.queue, (self.composed_id, task.time_estimate, task))
+        depth = len(task.get_path())
+        heapq.heappush(self.queue, (-depth, -task.rank, self.composed_id, task))
         self.composed_id += 1
 
 
-    def expand_tasks(self, assigned_tasks_limit):
+    def expand_tasks(self, assigned_tasks_limit, force=False):
         """
-        Expand composed tasks until number of planed tasks in the scheduler is under the given limit.
-        :return:
+        Expand composed tasks until number of live tasks in the scheduler is under the given limit.
+        New tasks are passed to the scheduler.
+        Composed tasks with unfinished inputs are deferred, so that their results can be looked up
+        in the cache before the expansion. A deferred task is expanded anyway if a resource is idle,
+        i.e. its body can overlap with the running tasks.
+        :param force: Expand at least one composed task regardless of the limit.
+        :return: List of the new tasks.
         """
         # Force end of evaluation before all tasks are finished, e.g. due to an error.
         schedule = []
-
-        while self.queue and not self.force_finish and self.scheduler.n_assigned_tasks < assigned_tasks_limit:
-            composed_id, time, composed_task = heapq.heappop(self.queue)
-            # TODO: fix expand, it connects Slots not to heads, but to an _ActionBase instance.
-            task_dict = composed_task.expand()
-            # print("Expanded: ", task_dict)
-            for task in task_dict.values():
-                if isinstance(task, task_mod.Composed):
-                    self.enqueue(task)
-                else:
-                    schedule.append(task)
-            self.tasks_update([composed_task])
+        waiting = []
+        inputs_finished = []
+        for composed_task in self.deferred:
+            if composed_task.inputs_finished():
+                inputs_finished.append(composed_task)
+            else:
+                waiting.append(composed_task)
+        self.deferred = waiting
+        for composed_task in self.scheduler.probe_cache(inputs_finished):
+            self.enqueue(composed_task)
+
+        while not self.force_finish:
+            while self.queue and not self.force_finish and \
+                    (force or self.scheduler.n_live_tasks < assigned_tasks_limit):
+                depth, rank, composed_id, composed_task = heapq.heappop(self.queue)
+                if not self.expand_all:
+                    if composed_task.inputs_finished():
+                        # Tasks probed already with the deferred tasks are not looked up again.
+                        if not self.scheduler.probe_cache([composed_task]):
+                            continue
+                    elif not force:
+                        self.deferred.append(composed_task)
+                        continue
+                force = False
+                # TODO: fix expand, it connects Slots not to heads, but to an _ActionBase instance.
+                task_dict = composed_task.expand()
+                # print("Expanded: ", task_dict)
+                # Heads just pass the results of the outer tasks, they are not scheduled.
+                new_tasks = [task for task in task_dict.values() if not isinstance(task, task_mod.ComposedHead)]
+                # Composed tasks are scheduled before expansion in order to compute ranks.
+                self.tasks_update(new_tasks + [composed_task])
+                for task in new_tasks:
+                    if isinstance(task, task_mod.Composed):
+                        self.enqueue(task)
+                schedule.extend(new_tasks)
+            if schedule or not self.deferred:
+                break
+            if not force and not (self.scheduler.is_idle()
+                                  and self.scheduler.n_live_tasks < assigned_tasks_limit):
+                break
+            # Expand the deferred task with the highest rank.
+            i_task = max(range(len(self.deferred)), key=lambda i: self.deferred[i].rank)
+            self.enqueue(self.deferred.pop(i_task))
+            force = True
         return schedule
 
     # def extract_input(self):
@@ -399,6 +1006,7 @@ class Evaluation:
 
 def run(action: Union[base._ActionBase, wrap.ActionWrapper],
         inputs:List[DataOrDummy] = None,
+        resources: List[Resource] = None,
         **kwargs) -> dtype.DataType:
     """
     Run the 'action' with given arguments 'inputs'.
@@ -409,5 +1017,5 @@ def run(action: Union[base._ActionBase, wrap.ActionWrapper],
     if inputs is None:
         inputs = []
     analysis = Evaluation.make_analysis(action, inputs)
-    eval_obj = Evaluation(analysis)
+    eval_obj = Evaluation(analysis, resources)
     return eval_obj.execute(**kwargs).result
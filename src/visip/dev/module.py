@@ -196,7 +196,10 @@ class Module:
             try:
                 if isinstance(obj, wrap.ActionWrapper):
                     obj = obj.action
-                full_name = ".".join([obj.__module__, name])
+                    module_name = obj.__visip_module__
+                else:
+                    module_name = obj.__module__
+                full_name = ".".join([module_name, name])
                 alias_name = ".".join([alias, name])
                 #print("ALIAS: ", full_name, alias_name)
                 self._visip_objs[full_name] = alias_name
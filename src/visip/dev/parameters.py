@@ -61,7 +61,7 @@ class ActionParameter:
         p_hash = data.hash(self.name)
         # TODO: possibly remove type spec from hashing, as it doesn't influance evaluation
         p_hash = data.hash(str(self.type), previous=p_hash)
-        p_hash = data.hash(self.default, previous=p_hash)
+        p_hash = data.hash(data.content_hash(self.default), previous=p_hash)
         p_hash = data.hash(self._idx, previous=p_hash)
         p_hash = data.hash(self.config_param, previous=p_hash)
         return p_hash
@@ -21,6 +21,9 @@ class Status(enum.IntEnum):
 
 
 class _TaskBase:
+    __slots__ = ('action', 'inputs', '_n_pending', 'outputs', 'id', 'parent', 'child_id', 'status',
+                 '_result', '_result_hash', 'resource_id', 'start_time', 'end_time', 'eval_time', 'rank')
+    # Large task DAGs are kept in memory, no per instance __dict__.
 
     no_value = cache.ResultCache.NoValue
 
@@ -29,9 +32,13 @@ class _TaskBase:
         # Action (like function definition) of the task (like function call).
         self.inputs = inputs
         # Input tasks for the action's arguments.
+        self._n_pending = 0
+        # Number of unfinished inputs. Decremented by the finished inputs, the task is ready when it drops to zero.
         for input in inputs:
             assert isinstance(input, _TaskBase)
             input.outputs.append(self)
+            if not input.is_finished():
+                self._n_pending += 1
         self.outputs: List['Atomic'] = []
         # List of tasks dependent on the result. (Try to not use and eliminate.)
         self.id: int = 0
@@ -46,41 +53,117 @@ class _TaskBase:
         self._result: Any = self.no_value
         # The task result.
         self._result_hash = None
-        # Hash of the result
+        # Content hash of the result. Unchanged result of a recomputed task keeps the hashes
+        # of the dependent tasks, so they are found in the cache (early cutoff).
         self.resource_id = None
 
         self.start_time = -1
         self.end_time = -1
         self.eval_time = 0
+        self.rank = 0.0
+        # Upward rank, the longest estimated evaluation time of a path from the task to the root task.
 
     def action_hash(self):
         return self.action.action_hash()
 
+    def task_hash(self):
+        """
+        Hash of the action and the result hashes of the inputs, the key of the result in the ResultCache.
+        """
+        task_hash = self.action_hash()
+        for input in self.inputs:
+            task_hash = data.hash(input.result_hash, previous=task_hash)
+        return task_hash
+
     @property
     def priority(self):
-        return 1
+        """
+        Tasks with higher priority are submitted first.
+        """
+        return self.rank
 
     @property
     def result(self):
-        return self._result
+        result = self._result
+        if type(result) is cache.LazyValue:
+            # Cached result is loaded when needed, the handle keeps the loaded value.
+            return result.get()
+        return result
 
     @property
     def result_hash(self):
         return self._result_hash
 
+    def prefetch_result(self):
+        """
+        Start loading of the cached result in background.
+        """
+        if type(self._result) is cache.LazyValue:
+            self._result.prefetch()
+
     def evaluate_fn(self):
         # Returns a function accepting the input data and computing the result.
         # e.g. action.evaluate
         assert False, "Not implemented."
 
-    def finish(self, result, task_hash):
+    def finish(self, result, task_hash, result_hash=None) -> List['_TaskBase']:
+        """
+        Set the result of the task.
+        :param result_hash: Content hash of the result, used by the dependent tasks. The task hash by default.
+        :return: Dependent tasks that have all inputs finished now.
+        """
         assert result is not self.no_value
         self.status = Status.finished
         self._result = result
-        self._result_hash = task_hash
+        self._result_hash = task_hash if result_hash is None else result_hash
+        return self._release_outputs()
+
+    def _release_outputs(self) -> List['_TaskBase']:
+        released = []
+        for output in self.outputs:
+            released.extend(output._input_finished())
+        return released
+
+    def _input_finished(self) -> List['_TaskBase']:
+        """
+        Called once for every finished input.
+        :return: List of tasks that have all inputs finished now.
+        """
+        self._n_pending -= 1
+        assert self._n_pending >= 0
+        return [self] if self._n_pending == 0 else []
+
+    def _reset_pending(self):
+        self._n_pending = sum(1 for input in self.inputs if not input.is_finished())
+
+    def inputs_finished(self):
+        return self._n_pending == 0
 
     def is_finished(self):
-        return self.result is not self.no_value
+        # The result value may be reclaimed, the result hash is kept.
+        return self.result_hash is not None
+
+    def _consumers(self):
+        # Tasks using the result, heads are transparent.
+        for output in self.outputs:
+            if isinstance(output, ComposedHead):
+                yield from output._consumers()
+            else:
+                yield output
+
+    def reclaim_result(self) -> bool:
+        """
+        Drop the result value of the finished task if all its consumers are finished.
+        The value remains available in the ResultCache under the task hash.
+        Tasks without outputs (e.g. the root task) keep the result.
+        :return: True if the value was dropped.
+        """
+        if not self.outputs or self._result is self.no_value:
+            return False
+        if not all(consumer.is_finished() for consumer in self._consumers()):
+            return False
+        self._result = self.no_value
+        return True
 
     def is_ready(self):
         assert False, "Not implemented."
@@ -122,7 +205,7 @@ class _TaskBase:
 
 
 class Atomic(_TaskBase):
-    pass
+    __slots__ = ()
 
 
 
@@ -131,10 +214,8 @@ class Atomic(_TaskBase):
         Update ready status, return
         :return:
         """
-        if self.status < Status.ready:
-            is_ready = all([task.is_finished() for task in self.inputs])
-            if is_ready:
-                self.status = Status.ready
+        if self.status < Status.ready and self._n_pending == 0:
+            self.status = Status.ready
         return self.status == Status.ready
 
     def evaluate_fn(self):
@@ -153,10 +234,25 @@ class ComposedHead(Atomic):
     Auxiliary task for the inputs of the composed task. Simplifies
     expansion as we need not to change input and output links of outer tasks, just link between head and tail.
     """
+    __slots__ = ()
+
     @property
     def result(self):
         return self.inputs[0].result
 
+    @property
+    def result_hash(self):
+        return self.inputs[0].result_hash
+
+    def prefetch_result(self):
+        self.inputs[0].prefetch_result()
+
+    def _input_finished(self):
+        # Head is finished together with its input.
+        self._n_pending -= 1
+        assert self._n_pending == 0
+        return self._release_outputs()
+
 
 class Composed(Atomic):
     """
@@ -164,14 +260,25 @@ class Composed(Atomic):
     The Evaluation class takes care of their expansion during execution according to the
     preferences assigned by the Scheduler. It also keeps a map from
     """
+    __slots__ = ('childs', 'heads')
 
     def __init__(self, action: 'dev._ActionBase', inputs: List['Atomic'] = []):
         heads = [ComposedHead(Pass(), [input]) for input in inputs]
         super().__init__(action, heads)
-        self.time_estimate = 0
-        # estimate of the start time, used as expansion priority
         self.childs: Atomic = None
         # map child_id to the child task, filled during expand.
+        self.heads = heads
+        # Inputs of the composed task, kept after expansion for the task hash.
+
+    def task_hash(self):
+        """
+        Hash of the action and the composed task inputs, so the result can be found
+        in the cache before the expansion.
+        """
+        task_hash = self.action_hash()
+        for head in self.heads:
+            task_hash = data.hash(head.result_hash, previous=task_hash)
+        return task_hash
 
     def is_ready(self):
         """
@@ -231,6 +338,7 @@ class Composed(Atomic):
             assert len(result_task.outputs) == 0
             result_task.outputs.append(self)
             self.inputs = [result_task]
+            self._reset_pending()
             # After expansion the composed task is just a dummy task dependent on the previoous result.
             # This works with Workflow, see how it will work with other composed actions:
             # if, reduce (for, while)
@@ -239,8 +347,31 @@ class Composed(Atomic):
             # No expansion: reconnect heads
             for head in heads:
                 head.outputs = [self]
+            self._reset_pending()
         return self.childs
 
+    def collapse(self) -> Optional[Dict[int, int]]:
+        """
+        Drop the body of the finished composed task, the heads are disconnected from the outer tasks.
+        Nested composed tasks should be collapsed before.
+        :return: Map from the IDs of the child tasks to their task hashes, i.e. the keys of the results in the cache,
+            None if some child task is not finished yet.
+        """
+        assert self.is_finished()
+        if not self.childs:
+            return None
+        if not all(child.is_finished() for child in self.childs.values()):
+            return None
+        index = {}
+        for child in self.childs.values():
+            if isinstance(child, ComposedHead):
+                child.inputs[0].outputs.remove(child)
+            else:
+                index[child.id] = child.task_hash()
+        self.childs = {}
+        self.inputs = []
+        return index
+
     def evaluate_fn(self):
         """
         Composed tasks use evaluate to finish expansion.
@@ -0,0 +1,118 @@
+"""
+Compact array representation of the Task DAG.
+
+Task objects remain the primary representation used by the evaluation. For large DAGs
+a snapshot in NumPy arrays indexed by integer task indices allows vectorized queries
+(number of ready tasks, evaluation time of a path, critical path ranks) without
+Python loops over the task objects.
+"""
+import itertools
+import numpy as np
+from typing import List, Iterable
+
+from . import dfs
+from .task import _TaskBase, Status
+
+_MASK_64 = (1 << 64) - 1
+
+
+class TaskArrays:
+    """
+    Snapshot of the task DAG:
+    - inputs in CSR format, inputs of the task 'i' are: input_idx[input_ptr[i]:input_ptr[i+1]]
+    - status, times and result hashes as columns indexed by the task index
+
+    Only the links between the given tasks are kept.
+    """
+    def __init__(self, tasks: List[_TaskBase]):
+        """
+        :param tasks: Tasks of the DAG, task index is the position in the list.
+        """
+        self.tasks = tasks
+        # Task objects, for the conversion of indices to tasks.
+        n_tasks = len(tasks)
+        index = {id(task): i for i, task in enumerate(tasks)}
+        input_lists = [[index[id(input)] for input in task.inputs if id(input) in index] for task in tasks]
+
+        self.input_ptr = np.zeros(n_tasks + 1, dtype=np.int64)
+        self.input_ptr[1:] = np.cumsum([len(inputs) for inputs in input_lists])
+        self.input_idx = np.fromiter(itertools.chain.from_iterable(input_lists),
+                                     dtype=np.int64, count=self.input_ptr[-1])
+        self.edge_task = np.repeat(np.arange(n_tasks), np.diff(self.input_ptr))
+        # Task index of every input edge.
+
+        self.status = np.fromiter((task.status for task in tasks), dtype=np.int8, count=n_tasks)
+        self.finished = np.fromiter((task.is_finished() for task in tasks), dtype=bool, count=n_tasks)
+        # Composed heads are finished together with their inputs, without change of the status.
+        self.start_time = np.fromiter((task.start_time for task in tasks), dtype=float, count=n_tasks)
+        self.end_time = np.fromiter((task.end_time for task in tasks), dtype=float, count=n_tasks)
+        self.eval_time = np.fromiter((task.eval_time for task in tasks), dtype=float, count=n_tasks)
+        self.rank = np.fromiter((task.rank for task in tasks), dtype=float, count=n_tasks)
+
+        self.result_hash = np.zeros((n_tasks, 2), dtype=np.uint64)
+        # Result hashes split to the low and high 64 bits, zero for unfinished tasks.
+        for i, task in enumerate(tasks):
+            if task.result_hash is not None:
+                self.result_hash[i] = (task.result_hash & _MASK_64, (task.result_hash >> 64) & _MASK_64)
+
+    @classmethod
+    def collect(cls, roots: Iterable[_TaskBase]) -> 'TaskArrays':
+        """
+        Make snapshot of all tasks the 'roots' depend on, in topological order.
+        """
+        tasks = []
+        dfs.DFS(neighbours=lambda task: task.inputs,
+                postvisit=tasks.append).run(roots)
+        return cls(tasks)
+
+    @property
+    def n_tasks(self):
+        return len(self.tasks)
+
+    def count(self, status: Status) -> int:
+        return int(np.count_nonzero(self.status == status))
+
+    def n_pending_inputs(self) -> np.ndarray:
+        """
+        Number of unfinished inputs of every task.
+        """
+        unfinished_edge = ~self.finished[self.input_idx]
+        return np.bincount(self.edge_task, weights=unfinished_edge, minlength=self.n_tasks).astype(np.int64)
+
+    def ready_mask(self) -> np.ndarray:
+        """
+        Tasks with all inputs finished that are not submitted yet.
+        """
+        return (~self.finished) & (self.n_pending_inputs() == 0) & (self.status < Status.submitted)
+
+    def n_ready(self) -> int:
+        return int(np.count_nonzero(self.ready_mask()))
+
+    def path_eval_time(self, path: np.ndarray) -> float:
+        """
+        Sum of eval times of the tasks given by the array of indices.
+        """
+        return float(self.eval_time[path].sum())
+
+    def _edges_of(self, tasks: np.ndarray) -> np.ndarray:
+        # Indices of the input edges of the given tasks.
+        starts = self.input_ptr[tasks]
+        lengths = self.input_ptr[tasks + 1] - starts
+        offsets = np.cumsum(lengths) - lengths
+        return np.arange(lengths.sum()) - np.repeat(offsets, lengths) + np.repeat(starts, lengths)
+
+    def upward_ranks(self) -> np.ndarray:
+        """
+        Longest estimated evaluation time from the start of a task to a task without outputs.
+        Computed by levels from the outputs to the inputs, one vectorized step per DAG level.
+        """
+        rank = self.eval_time.copy()
+        n_outputs = np.bincount(self.input_idx, minlength=self.n_tasks)
+        frontier = np.flatnonzero(n_outputs == 0)
+        while frontier.size:
+            edges = self._edges_of(frontier)
+            inputs = self.input_idx[edges]
+            np.maximum.at(rank, inputs, self.eval_time[inputs] + rank[self.edge_task[edges]])
+            np.subtract.at(n_outputs, inputs, 1)
+            frontier = np.unique(inputs[n_outputs[inputs] == 0])
+        return rank
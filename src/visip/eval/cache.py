@@ -1,21 +1,827 @@
+import os
+import heapq
+import socket
+import sqlite3
+import uuid
+import zlib
+import lzma
+import threading
+import time
+import contextlib
+import collections
+from concurrent import futures
 from typing import *
+import attr
+import numpy as np
+
+from ..dev import data
+
 
 class ResultCache:
     """
     Trivial implementation of the task hash database.
     Possible improvements:
-    - pemanent storage, store values in file, have only hashes in the memory
     - precise hash type
-    - safe also date of values, remove expired values
+    See DiskResultCache for the permanent storage with expiration of the values.
     """
     class NoValue:
         pass
 
     def __init__(self):
         self.cache: Dict[int, Any] = {}
+        self.result_hashes: Dict[int, int] = {}
+        # Content hashes of the values.
 
-    def value(self, hash_int:int) -> Any:
+    lazy_values = False
+    # True if the stored values are kept, so cache hits can be finished by LazyValue handles
+    # loaded when the value is needed.
+
+    def value(self, hash_int: int, result_hash: int = None) -> Any:
+        """
+        Value stored for the task hash 'hash_int', NoValue if not stored.
+        :param result_hash: Content hash of the value if known, saves a lookup in some caches.
+        """
         return self.cache.get(hash_int, ResultCache.NoValue)
 
-    def insert(self, hash_int, value):
-        self.cache[hash_int] = value
\ No newline at end of file
+    def result_hash(self, hash_int: int) -> Optional[int]:
+        """
+        Content hash of the value stored for the task hash 'hash_int', None if not stored.
+        """
+        return self.result_hashes.get(hash_int, None)
+
+    def probe(self, hash_ints: Iterable[int]) -> Dict[int, int]:
+        """
+        Batched 'result_hash', a single query for many task hashes.
+        :return: Maps the stored task hashes to the content hashes of their values.
+        """
+        return {h: self.result_hashes[h] for h in hash_ints if h in self.result_hashes}
+
+    def insert(self, hash_int, value, result_hash: int = None, cost: float = 1.0):
+        """
+        Store the 'value' for the task hash 'hash_int'.
+        :param result_hash: Content hash of the value, computed if not given.
+            The task hash is used for the values that can not be hashed by the content.
+        :param cost: Time of the value computation [s], used by the caches with eviction.
+        """
+        if result_hash is None:
+            result_hash = data.content_hash(value, hash_int)
+        self.cache[hash_int] = value
+        self.result_hashes[hash_int] = result_hash
+
+    def acquire_lease(self, hash_int: int) -> bool:
+        """
+        Reserve the computation of the task hash 'hash_int' for the caller.
+        :return: False if the task is computed by another process sharing the cache.
+        """
+        return True
+
+    def release_lease(self, hash_int: int):
+        pass
+
+    def close(self):
+        pass
+
+
+_codecs = {
+    # Codec name: (compress, decompress, magic bytes of the compressed stream).
+    'zlib': (lambda stream: zlib.compress(stream, 1), zlib.decompress, b'\x78'),
+    'lzma': (lambda stream: lzma.compress(stream, preset=1), lzma.decompress, b'\xfd7zXZ'),
+}
+# Serialized values start by the pickle protocol opcode b'\x80', the codec of a compressed value
+# is recognized by its magic bytes.
+
+
+def _decompress(stream: bytes) -> bytes:
+    if stream[:1] == b'\x80':
+        return stream
+    for compress, decompress, magic in _codecs.values():
+        if stream.startswith(magic):
+            return decompress(stream)
+    raise ValueError("Unknown format of the stored value.")
+
+
+class DiskResultCache(ResultCache):
+    """
+    Permanent task hash database in the directory 'cache_dir':
+    - 'index.sqlite', SQLite index of the stored results: task hash, content hash of the value,
+      computation time, creation and last access time; and of the stored values (blobs): content hash,
+      size, compression codec and the number of results referring to the value
+    - 'values/<xx>/<content hash>', serialized values sharded by the first two hex digits of the hash
+    - 'values/<xx>/<content hash>.buf', raw buffers of the large arrays, memory mapped read only when loaded
+
+    Values are content addressed, equal values of different tasks are stored once.
+    Only the index is kept in memory (by SQLite), values are read from the files on demand.
+    Values are written to a temporary file and renamed, so an interrupted run leaves no partial values.
+
+    The directory can be shared by concurrent processes, also on different nodes of a shared
+    file system. The 'leases' table of the index marks the task hashes being computed, so that every
+    task is computed by a single process while the others wait for its result. A lease expires
+    if not renewed for 'lease_time' seconds or if its owner process on the same node is gone.
+    The leases are renewed by a background thread, so they are kept during long evaluations
+    on any resource.
+
+    Serialized values larger than 'compress_min_size' are compressed, the codec is recorded in the index.
+    Raw buffers of the arrays are never compressed, so they can be memory mapped.
+
+    The size of the directory is bounded by 'collect_garbage', see also the 'cache_gc' command.
+    Values can be pinned by a label (e.g. name of an analysis), pinned values are never removed.
+    """
+    _hash_mask = (1 << 128) - 1
+
+    lease_time = 300.0
+    # Validity of a lease [s], renewed by the owner while it runs.
+
+    idle_scale = 24 * 3600.0
+    # Time since the last access [s] that halves the value of a cached result for the garbage collection.
+
+    compress_min_size = 4096
+    # Smaller serialized values are stored uncompressed.
+
+    def __init__(self, cache_dir: str, shared_fs: bool = False, timeout: float = 60.0, pin: str = None,
+                 compression: Optional[str] = 'zlib'):
+        """
+        :param shared_fs: The directory is on a network file system (NFS, Lustre) accessed from several nodes.
+            The SQLite write ahead log needs the shared memory of a single node, the rollback journal
+            is used instead.
+        :param timeout: Time to wait for the index locked by other processes [s].
+        :param pin: Label pinning all values stored or found in the cache, e.g. the name of the evaluated analysis.
+        :param compression: Codec of the stored values: 'zlib' (fast), 'lzma' (better ratio) or None.
+            Values stored with any codec are readable.
+        """
+        assert compression is None or compression in _codecs, "Unknown codec: {}".format(compression)
+        self.compression = compression
+        self.pin_label = pin
+        self.cache_dir = os.path.abspath(cache_dir)
+        self._values_dir = os.path.join(self.cache_dir, 'values')
+        os.makedirs(self._values_dir, exist_ok=True)
+        self._lock = threading.Lock()
+        # The connection is shared by the evaluation and the prefetch threads.
+        self._db = sqlite3.connect(os.path.join(self.cache_dir, 'index.sqlite'), timeout=timeout,
+                                   isolation_level=None, check_same_thread=False)
+        # Autocommit mode, transactions are explicit.
+        journal_mode = 'DELETE' if shared_fs else 'WAL'
+        self._db.execute("PRAGMA journal_mode={}".format(journal_mode))
+        self._host = socket.gethostname()
+        self._owner = uuid.uuid4().hex
+        # Owner of the leases, unique for every cache instance.
+        self._leases = set()
+        # Keys of the leases held by this instance.
+        self._renewer = None
+        # Thread renewing the leases, started by the first lease.
+        self._closed = threading.Event()
+        self._filter = None
+        # Bloom filter of the stored hashes, rejects most of the missing hashes without a query.
+        self._filter_id = 0
+        # Rows of the index up to this id are in the filter, rows inserted by any process get increasing ids.
+        self._accessed = {}
+        # Access times of the loaded values, written to the index in batches.
+        with self._transaction() as db:
+            db.execute("""
+                CREATE TABLE IF NOT EXISTS results (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    hash TEXT UNIQUE NOT NULL,
+                    result_hash TEXT NOT NULL,
+                    cost REAL NOT NULL,
+                    created REAL NOT NULL,
+                    accessed REAL NOT NULL)""")
+            db.execute("""
+                CREATE TABLE IF NOT EXISTS blobs (
+                    hash TEXT PRIMARY KEY,
+                    size INTEGER NOT NULL,
+                    codec TEXT,
+                    refs INTEGER NOT NULL)""")
+            db.execute("""
+                CREATE TABLE IF NOT EXISTS leases (
+                    hash TEXT PRIMARY KEY,
+                    owner TEXT NOT NULL,
+                    host TEXT NOT NULL,
+                    pid INTEGER NOT NULL,
+                    expires REAL NOT NULL)""")
+            db.execute("""
+                CREATE TABLE IF NOT EXISTS pins (
+                    hash TEXT NOT NULL,
+                    label TEXT NOT NULL,
+                    PRIMARY KEY (hash, label))""")
+
+    lazy_values = True
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        # Write transaction, the index is locked for other processes from its start.
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._db
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+            self._db.execute("COMMIT")
+
+    def _query_one(self, sql: str, params=()) -> Optional[tuple]:
+        with self._lock:
+            return self._db.execute(sql, params).fetchone()
+
+    def _modify(self, sql: str, params=()):
+        with self._lock:
+            self._db.execute(sql, params)
+
+    @classmethod
+    def _key(cls, hash_int: int) -> str:
+        # Fixed length hex representation, negative hashes are taken modulo 2**128.
+        return "{:032x}".format(hash_int & cls._hash_mask)
+
+    def _value_path(self, key: str) -> str:
+        return os.path.join(self._values_dir, key[:2], key)
+
+    def __len__(self):
+        return self._query_one("SELECT COUNT(*) FROM results")[0]
+
+    def __contains__(self, hash_int: int) -> bool:
+        return self._query_one("SELECT 1 FROM results WHERE hash = ?", (self._key(hash_int),)) is not None
+
+    def result_hash(self, hash_int: int) -> Optional[int]:
+        key = self._key(hash_int)
+        row = self._query_one("SELECT result_hash FROM results WHERE hash = ?", (key,))
+        if row is None:
+            return None
+        self._pin_keys([key])
+        return int(row[0], 16)
+
+    _batch_size = 500
+    # Number of the hashes in a single query (SQLite limits the number of the query parameters)
+    # and of the buffered access times.
+
+    def probe(self, hash_ints: Iterable[int]) -> Dict[int, int]:
+        hashes = {self._key(h): h for h in hash_ints}
+        found = {}
+        with self._lock:
+            self._update_filter()
+            keys = [key for key, maybe in zip(hashes, self._filter.contains(hashes)) if maybe]
+            for i in range(0, len(keys), self._batch_size):
+                chunk = keys[i:i + self._batch_size]
+                query = "SELECT hash, result_hash FROM results WHERE hash IN ({})".format(",".join("?" * len(chunk)))
+                for key, result_hash in self._db.execute(query, chunk):
+                    found[hashes[key]] = int(result_hash, 16)
+        self._pin_keys([self._key(h) for h in found])
+        return found
+
+    def _update_filter(self):
+        # Add the rows inserted since the last update, rebuild the filter if it is full.
+        last_id = self._db.execute("SELECT COALESCE(MAX(id), 0) FROM results").fetchone()[0]
+        if self._filter is not None and last_id == self._filter_id:
+            return
+        if self._filter is None or self._filter.n_keys + last_id - self._filter_id > self._filter.capacity:
+            n_rows = self._db.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+            self._filter = BloomFilter(capacity=max(2 * n_rows, 1 << 16))
+            self._filter_id = 0
+        rows = self._db.execute("SELECT hash FROM results WHERE id > ? AND id <= ?", (self._filter_id, last_id))
+        self._filter.add([key for key, in rows])
+        self._filter_id = last_id
+
+    def value(self, hash_int: int, result_hash: int = None) -> Any:
+        key = self._key(hash_int)
+        if result_hash is None:
+            result_hash = self.result_hash(hash_int)
+            if result_hash is None:
+                return ResultCache.NoValue
+        path = self._value_path(self._key(result_hash))
+        try:
+            with open(path, "rb") as f:
+                stream = f.read()
+            value = data.deserialize_buffers(_decompress(stream), path + ".buf")
+        except FileNotFoundError:
+            # Value removed outside of the cache or by the garbage collection, drop the possible stale index entry.
+            self._remove([key])
+            return ResultCache.NoValue
+        with self._lock:
+            self._accessed[key] = time.time()
+            n_accessed = len(self._accessed)
+        if n_accessed >= self._batch_size:
+            self._flush_accessed()
+        return value
+
+    def _flush_accessed(self):
+        # Write the buffered access times to the index in a single transaction.
+        with self._lock:
+            accessed, self._accessed = self._accessed, {}
+        if accessed:
+            with self._transaction() as db:
+                db.executemany("UPDATE results SET accessed = ? WHERE hash = ?",
+                               [(access_time, key) for key, access_time in accessed.items()])
+
+    def cost(self, hash_int: int) -> Optional[float]:
+        row = self._query_one("SELECT cost FROM results WHERE hash = ?", (self._key(hash_int),))
+        return None if row is None else row[0]
+
+    def insert(self, hash_int: int, value: Any, result_hash: int = None, cost: float = 1.0):
+        if result_hash is None:
+            result_hash = data.content_hash(value, hash_int)
+        key, blob_key = self._key(hash_int), self._key(result_hash)
+        blob = None
+        # Size and codec of the value written by this call.
+        if self._query_one("SELECT 1 FROM blobs WHERE hash = ?", (blob_key,)) is None:
+            # The value is written before the transaction, not to block the index.
+            blob = self._write_blob(blob_key, value)
+        freed = []
+        with self._transaction() as db:
+            if db.execute("SELECT 1 FROM blobs WHERE hash = ?", (blob_key,)).fetchone() is None:
+                if blob is None:
+                    # Removed by the garbage collection meanwhile.
+                    blob = self._write_blob(blob_key, value)
+                db.execute("INSERT INTO blobs (hash, size, codec, refs) VALUES (?, ?, ?, 0)", (blob_key,) + blob)
+            row = db.execute("SELECT result_hash FROM results WHERE hash = ?", (key,)).fetchone()
+            if row is None or row[0] != blob_key:
+                db.execute("UPDATE blobs SET refs = refs + 1 WHERE hash = ?", (blob_key,))
+                if row is not None:
+                    freed = self._release_blobs(db, [row[0]])
+            now = time.time()
+            db.execute("INSERT OR REPLACE INTO results (hash, result_hash, cost, created, accessed) "
+                       "VALUES (?, ?, ?, ?, ?)", (key, blob_key, cost, now, now))
+        self._remove_blob_files(freed)
+        self._pin_keys([key])
+
+    def _write_blob(self, blob_key: str, value: Any) -> Tuple[int, Optional[str]]:
+        """
+        Write the value files.
+        :return: Size of the files and the compression codec.
+        """
+        stream, buffers = data.serialize_buffers(value)
+        codec = None
+        if self.compression is not None and len(stream) >= self.compress_min_size:
+            compressed = _codecs[self.compression][0](stream)
+            if len(compressed) < 0.9 * len(stream):
+                # Incompressible values are kept raw, their decompression would be a waste of time.
+                codec, stream = self.compression, compressed
+        path = self._value_path(blob_key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        size = len(stream)
+        if buffers:
+            size += self._write_file(path + ".buf", lambda f: data.write_buffers(buffers, f))
+        self._write_file(path, lambda f: f.write(stream))
+        return size, codec
+
+    @staticmethod
+    def _release_blobs(db, blob_keys: List[str]) -> List[str]:
+        """
+        Decrease the reference counts of the blobs (by every occurrence in 'blob_keys') within a transaction.
+        :return: Keys of the unreferenced blobs, removed from the index.
+        """
+        counts = collections.Counter(blob_keys)
+        db.executemany("UPDATE blobs SET refs = refs - ? WHERE hash = ?",
+                       [(count, blob_key) for blob_key, count in counts.items()])
+        freed = [blob_key for blob_key in counts
+                 if db.execute("SELECT refs FROM blobs WHERE hash = ?", (blob_key,)).fetchone()[0] <= 0]
+        db.executemany("DELETE FROM blobs WHERE hash = ?", [(blob_key,) for blob_key in freed])
+        return freed
+
+    def _remove_blob_files(self, blob_keys: List[str]):
+        for blob_key in blob_keys:
+            path = self._value_path(blob_key)
+            for file_path in [path, path + ".buf"]:
+                try:
+                    os.remove(file_path)
+                except FileNotFoundError:
+                    pass
+
+    def _write_file(self, path, write):
+        # Write through a temporary file, so the file is either complete or missing.
+        # The name is unique for the processes on all nodes sharing the directory.
+        tmp_path = "{}.{}.{}.{}.tmp".format(path, self._host, os.getpid(), threading.get_ident())
+        try:
+            with open(tmp_path, "wb") as f:
+                size = write(f)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return size
+
+    def _pin_keys(self, keys: List[str]):
+        if self.pin_label is not None and keys:
+            with self._lock:
+                self._db.executemany("INSERT OR IGNORE INTO pins (hash, label) VALUES (?, ?)",
+                                     [(key, self.pin_label) for key in keys])
+
+    def pin(self, label: str, hash_ints: Iterable[int]):
+        """
+        Protect the values of the task hashes from the garbage collection.
+        """
+        with self._transaction() as db:
+            db.executemany("INSERT OR IGNORE INTO pins (hash, label) VALUES (?, ?)",
+                           [(self._key(h), label) for h in hash_ints])
+
+    def unpin(self, label: str) -> int:
+        """
+        Remove all pins with the label.
+        :return: Number of removed pins.
+        """
+        with self._transaction() as db:
+            return db.execute("DELETE FROM pins WHERE label = ?", (label,)).rowcount
+
+    def pin_labels(self) -> Dict[str, int]:
+        """
+        Maps the pin labels to the numbers of the pinned values.
+        """
+        with self._lock:
+            return dict(self._db.execute("SELECT label, COUNT(*) FROM pins GROUP BY label"))
+
+    def n_bytes(self) -> int:
+        """
+        Total size of the stored values, every distinct value counted once.
+        """
+        return self._query_one("SELECT COALESCE(SUM(size), 0) FROM blobs")[0]
+
+    def collect_garbage(self, max_bytes: int = None, max_age: float = None, max_idle: float = None,
+                        ignore_pins: Collection[str] = (), dry_run: bool = False) -> 'GCReport':
+        """
+        Remove the values that are not pinned:
+        - created more than 'max_age' seconds ago
+        - not accessed for 'max_idle' seconds
+        - the least valuable values while the total size exceeds 'max_bytes'; the value of a result is its
+          computation time per byte divided by (1 + t / idle_scale), t is the time since the last access,
+          so cheap, large and unused values are removed first.
+        The space of a value shared by several results is reclaimed when all of them are removed.
+
+        Evaluations using the cache concurrently may fail with ExcLostValue if their values are removed.
+        :param ignore_pins: Labels of the pins that do not protect the values.
+        :param dry_run: Just report the values that would be removed.
+        """
+        now = time.time()
+        self._flush_accessed()
+        ignore_pins = list(ignore_pins)
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT results.hash, result_hash, size, cost, created, accessed, "
+                "EXISTS (SELECT 1 FROM pins WHERE pins.hash = results.hash AND label NOT IN ({})) "
+                "FROM results JOIN blobs ON blobs.hash = result_hash".format(",".join("?" * len(ignore_pins))),
+                ignore_pins).fetchall()
+        refs = collections.Counter(blob_key for key, blob_key, *_ in rows)
+        n_bytes = sum({blob_key: size for key, blob_key, size, *_ in rows}.values())
+        n_bytes_kept = n_bytes
+        removed = []
+
+        def remove(key, blob_key, size):
+            nonlocal n_bytes_kept
+            removed.append(key)
+            refs[blob_key] -= 1
+            if refs[blob_key] == 0:
+                n_bytes_kept -= size
+
+        candidates = []
+        for key, blob_key, size, cost, created, accessed, pinned in rows:
+            expired = (max_age is not None and created < now - max_age) or \
+                      (max_idle is not None and accessed < now - max_idle)
+            if expired and not pinned:
+                remove(key, blob_key, size)
+            elif not pinned:
+                value = cost / max(size, 1) / (1.0 + (now - accessed) / self.idle_scale)
+                candidates.append((value, key, blob_key, size))
+        if max_bytes is not None and n_bytes_kept > max_bytes:
+            candidates.sort()
+            for value, key, blob_key, size in candidates:
+                if n_bytes_kept <= max_bytes:
+                    break
+                remove(key, blob_key, size)
+        report = GCReport(n_removed=len(removed), n_bytes_removed=n_bytes - n_bytes_kept,
+                          n_kept=len(rows) - len(removed), n_bytes_kept=n_bytes_kept)
+        if not dry_run:
+            self._remove(removed)
+        return report
+
+    def _remove(self, keys: List[str]):
+        # Remove from the index first, so the files of the removed values are not used.
+        with self._transaction() as db:
+            blob_keys = []
+            for key in keys:
+                row = db.execute("SELECT result_hash FROM results WHERE hash = ?", (key,)).fetchone()
+                if row is not None:
+                    blob_keys.append(row[0])
+            db.executemany("DELETE FROM results WHERE hash = ?", [(key,) for key in keys])
+            freed = self._release_blobs(db, blob_keys)
+            db.execute("DELETE FROM leases WHERE expires < ?", (time.time(),))
+        self._remove_blob_files(freed)
+
+    def _lease_valid(self, host: str, pid: int, expires: float) -> bool:
+        if expires < time.time():
+            return False
+        if host == self._host:
+            # The lease of a killed process on the same node can be taken over immediately.
+            try:
+                os.kill(pid, 0)
+            except ProcessLookupError:
+                return False
+            except OSError:
+                pass
+        return True
+
+    def acquire_lease(self, hash_int: int) -> bool:
+        key = self._key(hash_int)
+        with self._transaction() as db:
+            if db.execute("SELECT 1 FROM results WHERE hash = ?", (key,)).fetchone() is not None:
+                # Stored meanwhile by another process.
+                return False
+            row = db.execute("SELECT owner, host, pid, expires FROM leases WHERE hash = ?", (key,)).fetchone()
+            if row is not None and row[0] != self._owner and self._lease_valid(*row[1:]):
+                return False
+            db.execute("INSERT OR REPLACE INTO leases (hash, owner, host, pid, expires) VALUES (?, ?, ?, ?, ?)",
+                       (key, self._owner, self._host, os.getpid(), time.time() + self.lease_time))
+            self._leases.add(key)
+        if self._renewer is None:
+            self._renewer = threading.Thread(target=self._renew_loop, daemon=True)
+            self._renewer.start()
+        return True
+
+    def release_lease(self, hash_int: int):
+        key = self._key(hash_int)
+        with self._lock:
+            if key not in self._leases:
+                return
+            self._leases.remove(key)
+            self._db.execute("DELETE FROM leases WHERE hash = ? AND owner = ?", (key, self._owner))
+
+    def renew_leases(self):
+        """
+        Extend the leases held by this instance.
+        """
+        with self._lock:
+            if self._leases and not self._closed.is_set():
+                self._db.execute("UPDATE leases SET expires = ? WHERE owner = ?",
+                                 (time.time() + self.lease_time, self._owner))
+
+    def _renew_loop(self):
+        # Renew several times per the lease time.
+        while not self._closed.wait(max(self.lease_time / 4, 0.05)):
+            self.renew_leases()
+
+    def close(self):
+        self._closed.set()
+        if self._renewer is not None:
+            self._renewer.join()
+        self._flush_accessed()
+        with self._lock:
+            if self._leases:
+                self._db.execute("DELETE FROM leases WHERE owner = ?", (self._owner,))
+                self._leases = set()
+            self._db.close()
+
+
+@attr.s(auto_attribs=True)
+class GCReport:
+    n_removed: int
+    # Number of the removed values.
+    n_bytes_removed: int
+    # Reclaimed space.
+    n_kept: int
+    n_bytes_kept: int
+
+    def __str__(self):
+        return "removed {} values ({}), kept {} values ({})".format(
+            self.n_removed, format_size(self.n_bytes_removed), self.n_kept, format_size(self.n_bytes_kept))
+
+
+def format_size(n_bytes: int) -> str:
+    for unit in ['B', 'KiB', 'MiB', 'GiB']:
+        if n_bytes < 1024:
+            return "{:.4g} {}".format(n_bytes, unit)
+        n_bytes /= 1024
+    return "{:.4g} TiB".format(n_bytes)
+
+
+class BloomFilter:
+    """
+    Set of the hex keys of the 128 bit hashes with false positives (about 1% for the number of keys
+    up to the 'capacity') but no false negatives. The bit positions are derived from the two halves of the hash
+    (double hashing), the hashes are uniform already.
+    """
+    n_positions = 7
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        n_bits = 1 << int(np.ceil(np.log2(10 * capacity)))
+        self._mask = np.uint64(n_bits - 1)
+        self._bits = np.zeros(n_bits // 8, dtype=np.uint8)
+        self.n_keys = 0
+        # Number of added keys, including the repeated ones.
+
+    def _positions(self, keys: Iterable[str]) -> np.ndarray:
+        keys = list(keys)
+        low = np.fromiter((int(key[16:], 16) for key in keys), dtype=np.uint64, count=len(keys))
+        high = np.fromiter((int(key[:16], 16) for key in keys), dtype=np.uint64, count=len(keys)) | np.uint64(1)
+        steps = np.arange(self.n_positions, dtype=np.uint64)
+        with np.errstate(over='ignore'):
+            return (low[:, None] + steps[None, :] * high[:, None]) & self._mask
+
+    def add(self, keys: Iterable[str]):
+        keys = list(keys)
+        self.n_keys += len(keys)
+        positions = self._positions(keys).ravel()
+        bits = np.left_shift(np.uint8(1), (positions & np.uint64(7)).astype(np.uint8))
+        np.bitwise_or.at(self._bits, positions >> np.uint64(3), bits)
+
+    def contains(self, keys: Iterable[str]) -> np.ndarray:
+        """
+        :return: Bool array, False for the keys that are certainly not in the set.
+        """
+        positions = self._positions(keys)
+        bits = (self._bits[positions >> np.uint64(3)] >> (positions & np.uint64(7)).astype(np.uint8)) & 1
+        return np.all(bits, axis=1)
+
+
+def value_size(value: Any) -> int:
+    """
+    Memory size estimate of the value: 'nbytes' of arrays, length of the serialized value otherwise.
+    """
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    return len(data.serialize(value))
+
+
+class _Entry:
+    __slots__ = ('value', 'result_hash', 'size', 'cost', 'n_hits', 'priority', 'on_disk')
+
+    def __init__(self, value, result_hash, size, cost, on_disk):
+        self.value = value
+        self.result_hash = result_hash
+        self.size = size
+        self.cost = cost
+        self.n_hits = 1
+        self.priority = 0.0
+        self.on_disk = on_disk
+
+
+class BoundedResultCache(ResultCache):
+    """
+    In memory task hash database with a limited size of stored values.
+    Values are evicted by the GreedyDual-Size-Frequency policy: the entry priority is
+        L + cost * n_hits / size
+    where L is the priority of the last evicted entry (aging). Cheap, large and rarely used values
+    are evicted first, expensive ones are kept.
+    Evicted values are spilled to the optional 'disk' cache, values found in the disk cache are loaded
+    back to the memory.
+    """
+    def __init__(self, max_bytes: int, disk: DiskResultCache = None):
+        """
+        :param max_bytes: Limit of the total size of values in memory.
+        :param disk: Second level cache for the evicted values.
+        """
+        self.max_bytes = max_bytes
+        self.disk = disk
+        self.n_bytes = 0
+        # Total size of the values in memory.
+        self._entries: Dict[int, _Entry] = {}
+        self._queue = []
+        # Heap of (priority, hash), entries with changed priority are pushed again.
+        self._inflation = 0.0
+        # The 'L' value, priority of the last evicted entry.
+        self._lock = threading.RLock()
+        # Values may be loaded by the prefetch threads.
+
+    @property
+    def lazy_values(self):
+        # Evicted values are kept only on the disk.
+        return self.disk is not None
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, hash_int: int) -> bool:
+        return hash_int in self._entries
+
+    def _push(self, hash_int, entry):
+        entry.priority = self._inflation + entry.cost * entry.n_hits / max(entry.size, 1)
+        heapq.heappush(self._queue, (entry.priority, hash_int))
+
+    def value(self, hash_int: int, result_hash: int = None) -> Any:
+        with self._lock:
+            entry = self._entries.get(hash_int, None)
+            if entry is not None:
+                entry.n_hits += 1
+                self._push(hash_int, entry)
+                return entry.value
+            if self.disk is None:
+                return ResultCache.NoValue
+            value = self.disk.value(hash_int, result_hash)
+            if value is not ResultCache.NoValue:
+                self._add(hash_int, value, self.disk.result_hash(hash_int), self.disk.cost(hash_int), on_disk=True)
+            return value
+
+    def result_hash(self, hash_int: int) -> Optional[int]:
+        with self._lock:
+            entry = self._entries.get(hash_int, None)
+            if entry is not None:
+                return entry.result_hash
+        if self.disk is None:
+            return None
+        return self.disk.result_hash(hash_int)
+
+    def probe(self, hash_ints: Iterable[int]) -> Dict[int, int]:
+        found = {}
+        missing = []
+        with self._lock:
+            for hash_int in hash_ints:
+                entry = self._entries.get(hash_int, None)
+                if entry is None:
+                    missing.append(hash_int)
+                else:
+                    found[hash_int] = entry.result_hash
+        if self.disk is not None and missing:
+            found.update(self.disk.probe(missing))
+        return found
+
+    def insert(self, hash_int, value, result_hash: int = None, cost: float = 1.0):
+        if result_hash is None:
+            result_hash = data.content_hash(value, hash_int)
+        with self._lock:
+            self._add(hash_int, value, result_hash, cost, on_disk=False)
+
+    def _add(self, hash_int, value, result_hash, cost, on_disk):
+        old = self._entries.pop(hash_int, None)
+        if old is not None:
+            self.n_bytes -= old.size
+        size = value_size(value)
+        entry = _Entry(value, result_hash, size, cost, on_disk)
+        if size > self.max_bytes:
+            self._spill(hash_int, entry)
+            return
+        self._entries[hash_int] = entry
+        self.n_bytes += size
+        self._push(hash_int, entry)
+        self._evict()
+
+    def _evict(self):
+        while self.n_bytes > self.max_bytes:
+            priority, hash_int = heapq.heappop(self._queue)
+            entry = self._entries.get(hash_int, None)
+            if entry is None or entry.priority != priority:
+                # Outdated queue item.
+                continue
+            self._inflation = priority
+            del self._entries[hash_int]
+            self.n_bytes -= entry.size
+            self._spill(hash_int, entry)
+
+    def _spill(self, hash_int, entry):
+        if self.disk is not None and not entry.on_disk:
+            self.disk.insert(hash_int, entry.value, entry.result_hash, entry.cost)
+
+    def close(self):
+        """
+        Spill all values to the disk cache.
+        """
+        with self._lock:
+            for hash_int, entry in self._entries.items():
+                self._spill(hash_int, entry)
+            self._entries = {}
+            self._queue = []
+            self.n_bytes = 0
+        if self.disk is not None:
+            self.disk.close()
+
+
+class ExcLostValue(Exception):
+    pass
+
+
+class LazyValue:
+    """
+    Handle of a value stored in the cache, the value is loaded on the first access and kept by the handle.
+    Loading can be started in advance in a background thread by 'prefetch'.
+    """
+    __slots__ = ('cache', 'hash', 'result_hash', '_future', '__weakref__')
+
+    _executor = None
+    # Thread pool of the prefetch loads, shared by all handles, created on demand.
+    n_prefetch_threads = 4
+
+    def __init__(self, cache: ResultCache, hash_int: int, result_hash: int = None):
+        self.cache = cache
+        self.hash = hash_int
+        self.result_hash = result_hash
+        # Content hash of the value, if known.
+        self._future = None
+
+    @classmethod
+    def _get_executor(cls):
+        if cls._executor is None:
+            cls._executor = futures.ThreadPoolExecutor(max_workers=cls.n_prefetch_threads)
+        return cls._executor
+
+    def prefetch(self):
+        if self._future is None:
+            self._future = self._get_executor().submit(self._load)
+
+    def get(self) -> Any:
+        if self._future is None:
+            self._future = futures.Future()
+            try:
+                self._future.set_result(self._load())
+            except ExcLostValue as e:
+                self._future.set_exception(e)
+        return self._future.result()
+
+    def _load(self):
+        value = self.cache.value(self.hash, self.result_hash)
+        if value is ResultCache.NoValue:
+            raise ExcLostValue("Value of the task hash {:x} removed from the cache.".format(self.hash))
+        return value
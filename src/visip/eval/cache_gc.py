@@ -0,0 +1,80 @@
+"""
+Maintenance of the persistent result cache (DiskResultCache).
+
+Usage:
+    python -m visip.eval.cache_gc CACHE_DIR [--max-bytes 500G] [--max-age 90d] [--max-idle 30d]
+                                            [--unpin LABEL] [--dry-run]
+
+Removes the values that are not pinned and reports the reclaimed space.
+"""
+import sys
+import argparse
+
+from .cache import DiskResultCache
+
+_size_units = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+_time_units = {'': 1, 's': 1, 'm': 60, 'h': 3600, 'd': 24 * 3600, 'w': 7 * 24 * 3600}
+
+
+def _parse_with_unit(text: str, units) -> float:
+    text = text.strip()
+    unit = text[-1:] if text[-1:].isalpha() else ''
+    if unit not in units:
+        raise argparse.ArgumentTypeError("Unknown unit '{}' of '{}'.".format(unit, text))
+    number = text[:len(text) - len(unit)]
+    try:
+        return float(number) * units[unit]
+    except ValueError:
+        raise argparse.ArgumentTypeError("Invalid number '{}'.".format(text))
+
+
+def parse_size(text: str) -> int:
+    """
+    Size in bytes, with optional binary unit K, M, G or T, e.g. '500G'.
+    """
+    return int(_parse_with_unit(text.upper(), _size_units))
+
+
+def parse_duration(text: str) -> float:
+    """
+    Duration in seconds, with optional unit s, m, h, d or w, e.g. '30d'.
+    """
+    return _parse_with_unit(text, _time_units)
+
+
+def make_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog="python -m visip.eval.cache_gc",
+                                     description="Remove unpinned values from the visip result cache.")
+    parser.add_argument("cache_dir", help="Directory of the DiskResultCache.")
+    parser.add_argument("--max-bytes", type=parse_size, default=None,
+                        help="Quota of the total size of values, e.g. 500G.")
+    parser.add_argument("--max-age", type=parse_duration, default=None,
+                        help="Remove values created before this time, e.g. 90d.")
+    parser.add_argument("--max-idle", type=parse_duration, default=None,
+                        help="Remove values not used for this time, e.g. 30d.")
+    parser.add_argument("--unpin", action="append", default=[], metavar="LABEL",
+                        help="Remove pins with the label before the collection, can be repeated.")
+    parser.add_argument("--dry-run", action="store_true", help="Only report what would be removed.")
+    return parser
+
+
+def main(argv=None):
+    args = make_parser().parse_args(argv)
+    result_cache = DiskResultCache(args.cache_dir)
+    try:
+        if not args.dry_run:
+            for label in args.unpin:
+                print("unpinned {} values of '{}'".format(result_cache.unpin(label), label))
+        report = result_cache.collect_garbage(max_bytes=args.max_bytes, max_age=args.max_age,
+                                              max_idle=args.max_idle, ignore_pins=args.unpin,
+                                              dry_run=args.dry_run)
+        for label, n_pinned in sorted(result_cache.pin_labels().items()):
+            print("pinned by '{}': {} values".format(label, n_pinned))
+    finally:
+        result_cache.close()
+    print(("dry run, " if args.dry_run else "") + str(report))
+    return report
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -18,7 +18,7 @@ class GUIEvaluation(QWidget):
         self.eval_window = eval_window
 
         self.analysis = analysis
-        self.evaluation = Evaluation(self.analysis)
+        self.evaluation = Evaluation(self.analysis, expand_all=True)
         thread = threading.Thread(target=self.evaluation.execute, args=())
         thread.start()
         self.layout = QVBoxLayout(self)
@@ -45,12 +45,16 @@ class GUIEvaluation(QWidget):
             QApplication.processEvents()
 
     def run(self):
-        self.eval = Evaluation(self.analysis)
+        self.eval = Evaluation(self.analysis, expand_all=True)
         self.result = self.evaluation.execute()
 
 
     def double_click(self, g_action):
-        task = self.navigation.current_task().childs[g_action.name]
+        childs = self.navigation.current_task().childs
+        if not childs:
+            # Not expanded yet.
+            return
+        task = childs[g_action.name]
         if type(task) is Atomic:
             return
 
@@ -68,6 +68,9 @@ class EvaluationScene(GBaseModelScene):
             self.update()
 
     def update_states(self):
+        if not self.task.childs:
+            # Not expanded yet or collapsed.
+            return
         for instance_name, instance in self.task.childs.items():
             if not isinstance(instance.action, _Value):
                 action = self.get_action(instance_name)
@@ -1,5 +1,6 @@
 import os
 import shutil
+import threading
 import visip.dev.tools as tools
 import visip as wf
 from visip.dev import evaluation
@@ -90,3 +91,48 @@ def test_file_from_template_wf():
 def test_file_action_skipping():
     # Test that external operations are skipped once files are the same
     pass
+
+
+N_COMMANDS = 4
+# Create own flag file and wait until all commands create their flags.
+WAIT_FOR_ALL = """
+import os, sys, time
+open('flag_' + sys.argv[1], 'w').close()
+for i in range(100):
+    if len([f for f in os.listdir('.') if f.startswith('flag_')]) == int(sys.argv[2]):
+        sys.exit(0)
+    time.sleep(0.1)
+sys.exit(1)
+"""
+
+@wf.analysis
+def concurrent_commands():
+    return [wf.system(['python', '-c', WAIT_FOR_ALL, i, N_COMMANDS], workdir="_workspace/async")
+            for i in range(N_COMMANDS)]
+
+
+def test_async_system_resource():
+    with tools.change_cwd(script_dir):
+        shutil.rmtree(os.path.join("_workspace", "async"), ignore_errors=True)
+        os.makedirs(os.path.join("_workspace", "async"))
+    resource = evaluation.AsyncSystemResource(max_running=N_COMMANDS)
+    result = evaluation.run(concurrent_commands, resources=[resource], workspace=script_dir)
+    resource.close()
+    assert [res.return_code for res in result] == N_COMMANDS * [0]
+    assert result[0].workdir == os.path.join(script_dir, "_workspace", "async")
+
+
+def test_async_system_resource_thread():
+    # Resource created and used outside the main thread.
+    results = []
+
+    def evaluate():
+        resource = evaluation.AsyncSystemResource()
+        results.append(evaluation.run(wf.system, [['python', '-c', 'print(1)'], wf.SysFile.PIPE], resources=[resource]))
+        resource.close()
+
+    thread = threading.Thread(target=evaluate)
+    thread.start()
+    thread.join()
+    assert results[0].return_code == 0
+    assert results[0].stdout.strip() == b'1'
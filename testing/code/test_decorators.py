@@ -21,3 +21,40 @@ def test_enum_decorator():
     rep = representer.Representer(make_rel_name)
     assert "test_decorators.MyEnum.a" == x.__code__(rep)
 
+
+
+def make_action(body, version=None, name_space=None):
+    source = "def act(a: int) -> int:\n    return {}\n".format(body)
+    name_space = dict(name_space or {}, __name__='act_module')
+    exec(source, name_space)
+    return decorators.action_def(version=version)(name_space['act']).action
+
+
+def test_action_def_hash():
+    assert make_action("a + 1").action_hash() == make_action("a + 1").action_hash()
+    assert make_action("a + 1").action_hash() != make_action("a + 2").action_hash()
+    assert make_action("a + 1").action_hash() != make_action("a + 1", version="2").action_hash()
+
+    # Change of a called action changes the hash.
+    inc_1 = decorators.action_def(make_action("a + 1")._evaluate)
+    inc_2 = decorators.action_def(make_action("a + 2")._evaluate)
+    assert make_action("inc(a)", name_space=dict(inc=inc_1)).action_hash() != \
+           make_action("inc(a)", name_space=dict(inc=inc_2)).action_hash()
+
+    # Values captured by the closure of the action factories.
+    def make_scale(k):
+        @decorators.action_def
+        def scale(a: int) -> int:
+            return k * a
+        return scale.action
+
+    assert make_scale(2).action_hash() == make_scale(2).action_hash()
+    assert make_scale(2).action_hash() != make_scale(3).action_hash()
+
+    def make_apply(act):
+        @decorators.action_def
+        def apply(a: int) -> int:
+            return act(a)
+        return apply.action
+
+    assert make_apply(inc_1).action_hash() != make_apply(inc_2).action_hash()
@@ -1,3 +1,8 @@
+import os
+import sys
+import subprocess
+import enum
+import numpy as np
 from visip.dev import data
 from typing import *
 import attr
@@ -20,4 +25,61 @@ def test_data():
     hb2 = data.hash(b_inst2)
     assert hb1 == hb2
     b_inst.a = 134
-    assert hb1 != data.hash(b_inst)
\ No newline at end of file
+    assert hb1 != data.hash(b_inst)
+
+class Color(enum.IntEnum):
+    red = 1
+    green = 2
+
+
+def test_structural_hash():
+    # Truncated str() of large arrays must not collide.
+    a = np.zeros(10000)
+    b = a.copy()
+    b[5000] = 1.0
+    assert data.hash(a) != data.hash(b)
+    assert data.hash(a) == data.hash(a.copy())
+    assert data.hash(a) != data.hash(a.astype(np.float32))
+    assert data.hash(a) != data.hash(a.reshape(100, 100))
+    assert data.hash(a[::2]) == data.hash(np.ascontiguousarray(a[::2]))
+    # Array subclasses with a state not given by the buffer.
+    masked = np.ma.masked_array(a, mask=a > 0.5)
+    assert data.hash(masked) != data.hash(a)
+    assert data.hash(masked) != data.hash(np.ma.masked_array(b, mask=b > 0.5))
+    assert data.hash(masked) != data.hash(np.ma.masked_array(a, mask=a > 0.5, fill_value=-1.0))
+    assert data.hash(masked) == data.hash(np.ma.masked_array(a.copy(), mask=np.zeros_like(a, dtype=bool)))
+    assert data.hash(np.matrix([[1, 2]])) != data.hash(np.array([[1, 2]]))
+    # Arrays without the buffer protocol support.
+    dates = np.array(['2020-01-01', '2021-01-01'], dtype='datetime64[D]')
+    assert data.hash(dates) != data.hash(dates + 1)
+    assert data.hash(dates - dates[0]) != data.hash(dates)
+    assert data.hash(np.zeros((3, 0))) != data.hash(np.zeros((0, 3)))
+    # NumPy scalars differ from the Python scalars.
+    assert data.hash(np.float64(1.0)) != data.hash(1.0)
+    assert data.hash([np.float64(1.0)]) != data.hash([1.0])
+    # Independent of the object identities.
+    word = 'x' * 10
+    assert data.hash([word, word, {1: word}]) == data.hash(['x' * 10, 'x' * 10, {1: 'xxxxxxxxxx'}])
+
+    assert data.hash({1: 'a', 2: 'b'}) == data.hash({2: 'b', 1: 'a'})
+    assert data.hash([1, 2]) != data.hash((1, 2))
+    assert data.hash(['ab', 'c']) != data.hash(['a', 'bc'])
+    assert data.hash(1) != data.hash(1.0) != data.hash('1')
+    assert data.hash(Color.red) != data.hash(1)
+    assert data.hash(1, previous=data.hash(2)) != data.hash(2, previous=data.hash(1))
+    assert 0 <= data.hash(-1) < 2 ** 128
+    # Long lists of scalars are hashed by NumPy.
+    long = list(range(100))
+    assert data.hash(long) != data.hash(long[:-1] + [100])
+    assert data.hash(long) != data.hash([float(i) for i in long])
+    assert data.hash(long + [2 ** 70]) != data.hash(long + [2 ** 71])
+
+
+def test_hash_process_independent():
+    script = "from visip.dev import data; print(data.hash(['ahoj', {1: 2.5}, None]))"
+    hashes = set()
+    for seed in ['1', '2']:
+        env = dict(os.environ, PYTHONHASHSEED=seed)
+        out = subprocess.run([sys.executable, '-c', script], env=env, stdout=subprocess.PIPE, check=True).stdout
+        hashes.add(int(out))
+    assert hashes == {data.hash(['ahoj', {1: 2.5}, None])}
@@ -1,5 +1,7 @@
 import pytest
 import os
+import threading
+import time
 
 from visip.dev import evaluation, task, module
 from visip.code import decorators
@@ -71,3 +73,166 @@ def test_action_skipping():
     result = evaluation.run(make_calls)
     assert len(result) == 3
     assert global_n_calls == 2
+
+
+N_PARALLEL = 4
+parallel_barrier = threading.Barrier(N_PARALLEL, timeout=10)
+
+@decorators.action_def
+def wait_for_others(a: int) -> int:
+    # Pass only if N_PARALLEL calls run concurrently.
+    parallel_barrier.wait()
+    return a
+
+
+@decorators.analysis
+def make_parallel_calls(self):
+    return [wait_for_others(i) for i in range(N_PARALLEL)]
+
+
+def test_thread_pool_resource():
+    resource = evaluation.ThreadPoolResource(n_threads=N_PARALLEL)
+    result = evaluation.run(make_parallel_calls, resources=[resource])
+    resource.close()
+    assert result == list(range(N_PARALLEL))
+
+
+n_slow_calls = 0
+
+@decorators.action_def
+def slow_call(a: int) -> int:
+    global n_slow_calls
+    n_slow_calls += 1
+    time.sleep(0.1)
+    return a
+
+
+@decorators.analysis
+def make_same_calls(self):
+    return [slow_call(1) for i in range(N_PARALLEL)]
+
+
+def test_in_flight_deduplication():
+    resource = evaluation.ThreadPoolResource(n_threads=N_PARALLEL)
+    result = evaluation.run(make_same_calls, resources=[resource])
+    resource.close()
+    assert result == [1] * N_PARALLEL
+    # Calls with the same hash ready at the same time are evaluated once.
+    assert n_slow_calls == 1
+
+
+@decorators.action_def
+def process_id(a: int) -> int:
+    return os.getpid()
+
+
+@decorators.analysis
+def make_process_calls(self):
+    return [process_id(i) for i in range(N_PARALLEL)]
+
+
+def test_process_pool_resource():
+    resource = evaluation.ProcessPoolResource(n_workers=2, modules=[__name__])
+    assert resource.action_reference(process_id.action) == (__name__, 'process_id')
+    result = evaluation.run(make_process_calls, resources=[resource])
+    resource.close()
+    assert len(result) == N_PARALLEL
+    assert os.getpid() not in result
+
+
+@decorators.action_def
+def sleep_a_while(a: int) -> int:
+    time.sleep(0.5)
+    return a
+
+
+@decorators.analysis
+def make_sleeping_calls(self):
+    return [sleep_a_while(i) for i in range(N_PARALLEL)]
+
+
+def test_blocking_wait():
+    # The evaluation loop should not consume CPU while the tasks are running.
+    resource = evaluation.ThreadPoolResource(n_threads=2)
+    start = time.process_time()
+    result = evaluation.run(make_sleeping_calls, resources=[resource])
+    cpu_time = time.process_time() - start
+    resource.close()
+    assert result == list(range(N_PARALLEL))
+    assert cpu_time < 0.2
+
+
+@decorators.workflow
+def sleep_and_pair(self, a: int, b: int) -> list:
+    return [sleep_a_while(a), b]
+
+
+@decorators.analysis
+def make_overlapping_calls(self):
+    return sleep_and_pair(1, sleep_a_while(2))
+
+
+def test_overlap_composed_body():
+    # Body of the composed task waiting for a running input starts on the free thread.
+    resource = evaluation.ThreadPoolResource(n_threads=2)
+    start = time.perf_counter()
+    result = evaluation.run(make_overlapping_calls, resources=[resource])
+    elapsed = time.perf_counter() - start
+    resource.close()
+    assert result == [1, 2]
+    assert elapsed < 0.9
+
+
+@decorators.action_def
+def make_array(a: int) -> list:
+    return [a] * 1000
+
+
+@decorators.action_def
+def array_sum(a: list) -> int:
+    return sum(a)
+
+
+@decorators.workflow
+def sweep_case(self, a: int) -> int:
+    return array_sum(make_array(a))
+
+
+@decorators.analysis
+def make_sweep(self):
+    return [sweep_case(i) for i in range(20)]
+
+
+def reachable_tasks(root):
+    tasks, stack = set(), [root]
+    while stack:
+        t = stack.pop()
+        if id(t) not in tasks:
+            tasks.add(id(t))
+            stack.extend(t.inputs)
+            if isinstance(t, task.Composed) and t.childs:
+                stack.extend(t.childs.values())
+    return len(tasks)
+
+
+def test_reclaim():
+    analysis = evaluation.Evaluation.make_analysis(make_sweep.action, [])
+    keep_eval = evaluation.Evaluation(analysis)
+    keep_result = keep_eval.execute().result
+    analysis = evaluation.Evaluation.make_analysis(make_sweep.action, [])
+    reclaim_eval = evaluation.Evaluation(analysis, reclaim=True)
+    final_task = reclaim_eval.execute()
+    assert final_task.result == keep_result == [1000 * i for i in range(20)]
+    assert reachable_tasks(final_task) < reachable_tasks(keep_eval.final_task) / 10
+    # Collapsed tasks are indexed by the task ID, dropped values are recovered from the result cache.
+    assert not final_task.childs['make_sweep_1'].childs
+    kept_tasks = [t for t in keep_eval.task_arrays().tasks if t.id in reclaim_eval.result_index]
+    assert len(kept_tasks) > 100
+    for t in kept_tasks:
+        assert reclaim_eval.result_index[t.id] == t.task_hash()
+    arrays = [t for t in kept_tasks if t.action.name == 'make_array']
+    assert len(arrays) == 20
+    assert reclaim_eval.indexed_result(arrays[3].id) == [arrays[3].inputs[0].result] * 1000
+    sweep_task = final_task.childs['make_sweep_1']
+    assert sweep_task._result is task.Atomic.no_value
+    assert reclaim_eval.task_result(sweep_task) == keep_result
@@ -0,0 +1,139 @@
+import heapq
+import numpy as np
+
+from visip.dev import evaluation, task as task_mod
+from visip.action import constructor
+from visip.code import decorators
+
+
+class SimulatedResource(evaluation.Resource):
+    """
+    Evaluates the tasks immediately, but reports them finished according to
+    the virtual time given by the action durations.
+    """
+    def __init__(self, n_slots, durations):
+        super().__init__()
+        self.n_threads = n_slots
+        self.durations = durations
+        self.time = 0.0
+        self._running = []
+
+    @property
+    def n_running(self):
+        return len(self._running)
+
+    def _execute(self, task, task_hash):
+        value = task.evaluate_fn()([input.result for input in task.inputs])
+        end_time = self.time + self.durations.get(task.action.name, 0.0)
+        heapq.heappush(self._running, (end_time, id(task), task, task_hash, value))
+
+    def get_finished(self):
+        if self._running:
+            self.time = self._running[0][0]
+            while self._running and self._running[0][0] == self.time:
+                end_time, _, task, task_hash, value = heapq.heappop(self._running)
+                self._store(task, task_hash, value)
+        return super().get_finished()
+
+
+@decorators.action_def
+def long_step(a: int) -> int:
+    return a + 1
+
+
+@decorators.action_def
+def short_step(a: int) -> int:
+    return a
+
+
+@decorators.analysis
+def chain_and_shorts(self):
+    self.chain = long_step(long_step(long_step(0)))
+    return [short_step(i) for i in range(4)] + [self.chain]
+
+
+DURATIONS = dict(long_step=10.0, short_step=3.0)
+
+def simulate(critical_path):
+    resource = SimulatedResource(2, DURATIONS)
+    analysis = evaluation.Evaluation.make_analysis(chain_and_shorts.action, [])
+    eval = evaluation.Evaluation(analysis, [resource], eval_time_estimates=DURATIONS)
+    eval.scheduler.critical_path = critical_path
+    result = eval.execute().result
+    return result, resource.time
+
+
+def test_critical_path_makespan():
+    fifo_result, fifo_makespan = simulate(critical_path=False)
+    cpm_result, cpm_makespan = simulate(critical_path=True)
+    assert fifo_result == cpm_result == [0, 1, 2, 3, 3]
+    # FIFO runs short steps first, then the chain of long steps.
+    assert fifo_makespan == 36.0
+    # CPM starts the chain immediately, short steps run in parallel.
+    assert cpm_makespan == 30.0
+
+
+@decorators.workflow
+def long_chain(self, a: int) -> int:
+    return long_step(long_step(a))
+
+
+@decorators.analysis
+def nested_chains(self):
+    self.first = long_chain(short_step(0))
+    return [long_chain(self.first), short_step(1), long_chain(short_step(2))]
+
+
+def test_incremental_ranks():
+    analysis = evaluation.Evaluation.make_analysis(nested_chains.action, [])
+    eval = evaluation.Evaluation(analysis, eval_time_estimates=DURATIONS)
+    eval.tasks_update(eval.expand_tasks(np.inf))
+    tasks = list(eval.scheduler.tasks.values())
+    incremental_ranks = [task.rank for task in tasks]
+    eval.scheduler.optimize()
+    assert incremental_ranks == [task.rank for task in tasks]
+
+
+def test_pending_inputs_counter():
+    values = [task_mod._TaskBase._create_task(None, i, constructor.Value(i), []) for i in range(100)]
+    list_task = task_mod._TaskBase._create_task(None, 'list', constructor.A_list(), values)
+    assert not list_task.is_ready()
+    for value_task in values[:-1]:
+        assert value_task.is_ready()
+        assert value_task.finish(result=value_task.action.value, task_hash=value_task.id) == []
+    assert not list_task.is_ready()
+    last = values[-1]
+    assert last.finish(result=last.action.value, task_hash=last.id) == [list_task]
+    assert list_task.is_ready()
+
+
+@decorators.workflow
+def sweep_item(self, a: int) -> int:
+    self.b = long_chain(short_step(a))
+    return long_chain(short_step(self.b))
+
+
+@decorators.analysis
+def sweep(self):
+    return [sweep_item(i) for i in range(50)]
+
+
+def peak_live_tasks(assigned_tasks_limit):
+    analysis = evaluation.Evaluation.make_analysis(sweep.action, [])
+    eval = evaluation.Evaluation(analysis)
+    peak = 0
+    scheduler_update = eval.scheduler.update
+    def update():
+        nonlocal peak
+        peak = max(peak, eval.scheduler.n_live_tasks)
+        return scheduler_update()
+    eval.scheduler.update = update
+    result = eval.execute(assigned_tasks_limit=assigned_tasks_limit).result
+    return result, peak
+
+
+def test_streaming_expansion():
+    full_result, full_peak = peak_live_tasks(np.inf)
+    stream_result, stream_peak = peak_live_tasks(10)
+    assert full_result == stream_result == [i + 4 for i in range(50)]
+    assert 2 * stream_peak < full_peak
@@ -0,0 +1,43 @@
+import numpy as np
+
+from visip.dev import evaluation, task as task_mod
+from visip.code import decorators
+
+
+@decorators.action_def
+def add(a: int, b: int) -> int:
+    return a + b
+
+
+@decorators.workflow
+def add_chain(self, a: int, b: int) -> int:
+    return add(add(a, b), b)
+
+
+@decorators.analysis
+def chains(self):
+    self.first = add_chain(1, 2)
+    return [add_chain(self.first, 3), add(4, 5)]
+
+
+def test_task_arrays():
+    analysis = evaluation.Evaluation.make_analysis(chains.action, [])
+    eval = evaluation.Evaluation(analysis, eval_time_estimates=dict(add=2.0))
+    eval.expand_tasks(np.inf)
+
+    arrays = eval.task_arrays()
+    assert arrays.tasks[-1] is eval.final_task
+    assert arrays.n_tasks == len(set(id(task) for task in arrays.tasks))
+    ready = [task for task in arrays.tasks if not isinstance(task, task_mod.ComposedHead) and task.is_ready()]
+    assert arrays.n_ready() == len(ready)
+    assert np.all(arrays.upward_ranks() == arrays.rank)
+    assert arrays.path_eval_time(np.arange(arrays.n_tasks)) == sum(task.eval_time for task in arrays.tasks)
+
+    result = eval.execute().result
+    assert result == [11, 9]
+    arrays = eval.task_arrays()
+    assert arrays.n_ready() == 0
+    assert np.all(arrays.finished)
+    assert arrays.count(task_mod.Status.finished) == \
+           sum(not isinstance(task, task_mod.ComposedHead) for task in arrays.tasks)
+    assert np.all(arrays.result_hash.any(axis=1))
@@ -73,3 +73,40 @@ def test_workflow_modification():
     res = w.set_action_input(list_2, 0, list_1)     # Cycle
     assert not res
     assert len(list_2.arguments) == 0
+
+
+def test_workflow_hash():
+    def make_wf(name):
+        w = wf._Workflow(name)
+        w.insert_slot(0, wf._SlotCall("a"))
+        list_1 = instance.ActionCall.create(constructor.A_list())
+        w.set_action_input(list_1, 0, w.slots[0])
+        w.set_action_input(w.result, 0, list_1)
+        return w, list_1
+
+    w, list_1 = make_wf("w")
+    w_hash = w.action_hash()
+    # Structural, independent of the names.
+    assert make_wf("other_name")[0].action_hash() == w_hash
+    list_1.name = "renamed"
+    assert w.action_hash() == w_hash
+
+    # Edits invalidate the memoized hash.
+    value = instance.ActionCall.create(constructor.Value(1))
+    w.set_action_input(list_1, 1, value)
+    assert w.action_hash() != w_hash
+    w.set_action_input(list_1, 1, None)
+    assert w.action_hash() == w_hash
+    w.insert_slot(1, wf._SlotCall("b"))
+    assert w.action_hash() != w_hash
+    w.remove_slot(1)
+    assert w.action_hash() == w_hash
+
+    # Edit of a called workflow changes the hash of the caller.
+    outer = wf._Workflow("outer")
+    w_call = instance.ActionCall.create(w)
+    outer.set_action_input(w_call, 0, instance.ActionCall.create(constructor.Value(2)))
+    outer.set_action_input(outer.result, 0, w_call)
+    outer_hash = outer.action_hash()
+    w.set_action_input(list_1, 1, value)
+    assert outer.action_hash() != outer_hash
@@ -0,0 +1,577 @@
+import os
+import shutil
+import threading
+import time
+import typing
+import numpy as np
+import pytest
+
+from visip.dev import evaluation, data
+from visip.eval import cache, cache_gc
+from visip.code import decorators
+
+
+def make_cache_dir(name):
+    cache_dir = os.path.join(os.path.dirname(__file__), "_workspace", name)
+    shutil.rmtree(cache_dir, ignore_errors=True)
+    return cache_dir
+
+
+def test_disk_cache():
+    cache_dir = make_cache_dir("disk_cache")
+    result_cache = cache.DiskResultCache(cache_dir)
+    assert result_cache.value(123) is cache.ResultCache.NoValue
+    result_cache.insert(123, [1, "two", {3: 4.0}])
+    result_cache.insert(-5, None)
+    assert result_cache.value(123) == [1, "two", {3: 4.0}]
+    assert result_cache.value(-5) is None
+    result_cache.close()
+
+    # Values persist, only the index is loaded.
+    result_cache = cache.DiskResultCache(cache_dir)
+    assert len(result_cache) == 2
+    assert 123 in result_cache
+    assert result_cache.value(123) == [1, "two", {3: 4.0}]
+
+    # Missing value file is a cache miss.
+    os.remove(result_cache._value_path(result_cache._key(result_cache.result_hash(123))))
+    assert result_cache.value(123) is cache.ResultCache.NoValue
+    assert len(result_cache) == 1
+    result_cache.close()
+
+
+n_calls = 0
+
+@decorators.action_def
+def count_calls(a: int) -> int:
+    global n_calls
+    n_calls += 1
+    return 2 * a
+
+
+@decorators.analysis
+def make_calls(self):
+    return [count_calls(i) for i in range(5)]
+
+
+def test_rerun_with_disk_cache():
+    global n_calls
+    n_calls = 0
+    cache_dir = make_cache_dir("rerun")
+    for i_run in range(2):
+        result_cache = cache.DiskResultCache(cache_dir)
+        resource = evaluation.Resource(cache=result_cache)
+        result = evaluation.run(make_calls, resources=[resource])
+        result_cache.close()
+        assert result == [0, 2, 4, 6, 8]
+        # The second run takes all results from the cache.
+        assert n_calls == 5
+
+
+@decorators.workflow
+def preprocess(self, a: int) -> int:
+    return count_calls(count_calls(a))
+
+
+@decorators.workflow
+def postprocess(self, a: int, b: int) -> list:
+    return [count_calls(a), b]
+
+
+@decorators.workflow
+def two_stages(self, a: int, b: int) -> list:
+    self.pre = preprocess(a)
+    return postprocess(self.pre, b)
+
+
+def test_composed_cache_lookup():
+    global n_calls
+    resource = evaluation.Resource()
+
+    def evaluate(a, b, **kwargs):
+        analysis = evaluation.Evaluation.make_analysis(two_stages.action, [a, b])
+        eval = evaluation.Evaluation(analysis, [resource], **kwargs)
+        eval.execute()
+        return eval
+
+    n_calls = 0
+    eval = evaluate(1, 2)
+    assert eval.final_task.result == [8, 2]
+    assert n_calls == 3
+
+    # Whole analysis is cached, no expansion.
+    eval = evaluate(1, 2)
+    assert eval.final_task.result == [8, 2]
+    assert n_calls == 3
+    assert not eval.final_task.is_expanded()
+
+    # Only the last stage is evaluated, preprocessing is not expanded.
+    eval = evaluate(1, 3)
+    assert eval.final_task.result == [8, 3]
+    assert n_calls == 3
+    stages = eval.final_task.childs['two_stages_1']
+    assert not stages.childs['pre'].is_expanded()
+    assert stages.childs['postprocess_1'].is_expanded()
+
+    # Interactive evaluation expands all composed tasks, atomic tasks are taken from the cache.
+    eval = evaluate(1, 3, expand_all=True)
+    assert eval.final_task.result == [8, 3]
+    assert n_calls == 3
+    stages = eval.final_task.childs['two_stages_1']
+    assert stages.childs['pre'].is_expanded()
+    assert stages.childs['postprocess_1'].is_expanded()
+
+
+@decorators.action_def
+def absolute(a: int) -> int:
+    return abs(a)
+
+
+@decorators.workflow
+def normalized_calls(self, a: int) -> int:
+    return count_calls(absolute(a))
+
+
+def test_early_cutoff():
+    global n_calls
+    resource = evaluation.Resource()
+    n_calls = 0
+    assert evaluation.run(normalized_calls, [2], resources=[resource]) == 4
+    assert n_calls == 1
+    # 'absolute' is recomputed, its result is unchanged so 'count_calls' is taken from the cache.
+    assert evaluation.run(normalized_calls, [-2], resources=[resource]) == 4
+    assert n_calls == 1
+    assert evaluation.run(normalized_calls, [3], resources=[resource]) == 6
+    assert n_calls == 2
+
+
+class Box:
+    def __init__(self, value):
+        self.value = value
+
+    def __repr__(self):
+        return "Box"
+
+
+@decorators.action_def
+def make_box(a: int) -> Box:
+    return Box(a)
+
+
+@decorators.action_def
+def unbox(box: Box) -> int:
+    return box.value
+
+
+@decorators.action_def
+def make_getter(a: int) -> typing.Any:
+    return lambda: a
+
+
+@decorators.action_def
+def call_getter(getter: typing.Any) -> int:
+    return getter()
+
+
+@decorators.analysis
+def make_boxes(self):
+    return [unbox(make_box(1)), unbox(make_box(2)), call_getter(make_getter(3)), call_getter(make_getter(4))]
+
+
+def test_early_cutoff_objects():
+    # Objects are hashed by their pickle, not by their str, unpicklable values by the task hash.
+    assert evaluation.run(make_boxes, resources=[evaluation.Resource()]) == [1, 2, 3, 4]
+    assert data.hash(Box(1)) != data.hash(Box(2))
+    with pytest.raises(data.ExcNotHashable):
+        data.hash(lambda: 1)
+
+
+def test_bounded_cache():
+    disk = cache.DiskResultCache(make_cache_dir("bounded"))
+    result_cache = cache.BoundedResultCache(max_bytes=10000, disk=disk)
+    expensive = np.ones(500)      # 4000 B
+    cheap = np.zeros(500)
+    result_cache.insert(1, expensive, cost=10.0)
+    result_cache.insert(2, cheap, cost=0.1)
+    assert result_cache.n_bytes == 8000
+    # Cheap value is evicted to the disk, expensive is kept.
+    result_cache.insert(3, np.arange(500), cost=1.0)
+    assert result_cache.n_bytes <= 10000
+    assert 1 in result_cache and 2 not in result_cache and 3 in result_cache
+    assert 2 in disk and 1 not in disk
+    # Loaded back from the disk with the same content hash.
+    assert np.all(result_cache.value(2) == cheap)
+    assert result_cache.result_hash(2) == disk.result_hash(2)
+    assert result_cache.n_bytes <= 10000
+    # Too large values go directly to the disk.
+    result_cache.insert(4, np.ones(2000), cost=100.0)
+    assert 4 not in result_cache and 4 in disk
+    result_cache.close()
+
+    # Without the disk evicted values are lost.
+    result_cache = cache.BoundedResultCache(max_bytes=100)
+    result_cache.insert(1, "x" * 200)
+    assert result_cache.value(1) is cache.ResultCache.NoValue
+    assert result_cache.n_bytes == 0
+
+
+def test_evaluation_with_bounded_cache():
+    global n_calls
+    n_calls = 0
+    resource = evaluation.Resource(cache=cache.BoundedResultCache(max_bytes=10 ** 6))
+    assert evaluation.run(make_calls, resources=[resource]) == [0, 2, 4, 6, 8]
+    assert evaluation.run(make_calls, resources=[resource]) == [0, 2, 4, 6, 8]
+    assert n_calls == 5
+
+
+def test_disk_cache_memmap():
+    result_cache = cache.DiskResultCache(make_cache_dir("memmap"))
+    field = np.arange(100000, dtype=float).reshape(1000, 100)
+    value = dict(field=field, transposed=field.T, small=np.ones(3), name="mesh")
+    result_cache.insert(1, value)
+    loaded = result_cache.value(1)
+    # Large arrays are mapped read only, not read.
+    assert isinstance(loaded['field'], np.memmap)
+    assert not loaded['field'].flags.writeable
+    assert not isinstance(loaded['small'], np.memmap)
+    for key in ['field', 'transposed', 'small']:
+        assert np.all(loaded[key] == value[key])
+    assert loaded['name'] == "mesh"
+    assert data.hash(loaded) == data.hash(value)
+
+    # Array subclasses are pickled with their state.
+    masked = np.ma.masked_array(np.ones(20000) * 1e4, mask=np.arange(20000) % 2 == 0)
+    result_cache.insert(2, masked)
+    loaded = result_cache.value(2)
+    assert isinstance(loaded, np.ma.MaskedArray)
+    assert np.all(loaded.mask == masked.mask)
+    assert loaded.sum() == 1e8
+
+    # Dtypes without the buffer protocol support.
+    dates = np.datetime64('2020-01-01') + np.arange(20000)
+    result_cache.insert(3, dates)
+    assert np.all(result_cache.value(3) == dates)
+
+    # Failed write leaves no temporary file.
+    def failing_write(f):
+        f.write(b'partial')
+        raise ValueError("Write failed.")
+    path = os.path.join(result_cache.cache_dir, "failed")
+    with pytest.raises(ValueError):
+        result_cache._write_file(path, failing_write)
+    assert not [name for name in os.listdir(result_cache.cache_dir) if name.startswith("failed")]
+    result_cache.close()
+
+
+class CountingDiskCache(cache.DiskResultCache):
+    def __init__(self, cache_dir):
+        super().__init__(cache_dir)
+        self.n_loads = 0
+
+    def value(self, hash_int, result_hash=None):
+        self.n_loads += 1
+        return super().value(hash_int, result_hash)
+
+
+def test_lazy_results():
+    global n_calls
+    cache_dir = make_cache_dir("lazy")
+
+    def evaluate(a, b):
+        result_cache = CountingDiskCache(cache_dir)
+        analysis = evaluation.Evaluation.make_analysis(two_stages.action, [a, b])
+        eval = evaluation.Evaluation(analysis, [evaluation.Resource(cache=result_cache)])
+        eval.execute()
+        return eval.final_task, result_cache
+
+    n_calls = 0
+    final_task, result_cache = evaluate(1, 2)
+    assert final_task.result == [8, 2]
+    assert n_calls == 3
+
+    # Fully cached, the value is loaded only when accessed.
+    final_task, result_cache = evaluate(1, 2)
+    assert result_cache.n_loads == 0
+    assert final_task.result == [8, 2]
+    assert result_cache.n_loads == 1
+
+    # Only the cached inputs of the recomputed tasks are loaded.
+    final_task, result_cache = evaluate(1, 3)
+    assert final_task.result == [8, 3]
+    assert n_calls == 3
+    assert result_cache.n_loads == 2
+
+
+def test_lazy_value_prefetch():
+    result_cache = cache.DiskResultCache(make_cache_dir("prefetch"))
+    result_cache.insert(1, [1, 2, 3])
+    lazy = cache.LazyValue(result_cache, 1)
+    lazy.prefetch()
+    assert lazy.get() == [1, 2, 3]
+    lost = cache.LazyValue(result_cache, 2)
+    with pytest.raises(cache.ExcLostValue):
+        lost.get()
+
+
+@decorators.action_def
+def failing(a: int) -> int:
+    raise ValueError("Failed.")
+
+
+@decorators.analysis
+def make_failing_call(self):
+    return failing(1)
+
+
+def test_lease_released_on_error():
+    cache_dir = make_cache_dir("lease_error")
+    for resource_class in [evaluation.Resource, evaluation.ThreadPoolResource]:
+        result_cache = cache.DiskResultCache(cache_dir)
+        resource = resource_class(cache=result_cache)
+        with pytest.raises(ValueError):
+            evaluation.run(make_failing_call, resources=[resource])
+        assert not result_cache._leases
+        assert result_cache._query_one("SELECT COUNT(*) FROM leases")[0] == 0
+        resource.close()
+        result_cache.close()
+
+
+def test_leases():
+    cache_dir = make_cache_dir("leases")
+    first = cache.DiskResultCache(cache_dir)
+    second = cache.DiskResultCache(cache_dir)
+    assert first.acquire_lease(1)
+    # Leases are reentrant for the owner only.
+    assert first.acquire_lease(1)
+    assert not second.acquire_lease(1)
+    first.release_lease(1)
+    assert second.acquire_lease(1)
+    # Stored results are not leased again.
+    second.insert(1, "one")
+    second.release_lease(1)
+    assert not first.acquire_lease(1)
+
+    # Leases are renewed in background during a long computation.
+    third = cache.DiskResultCache(cache_dir)
+    third.lease_time = 0.2
+    assert third.acquire_lease(4)
+    time.sleep(0.5)
+    assert not second.acquire_lease(4)
+    third.close()
+
+    # Expired leases are taken over.
+    assert first.acquire_lease(2)
+    second.lease_time = 0.0
+    assert second.acquire_lease(3)
+    assert not second.acquire_lease(2)
+    assert first.acquire_lease(3)
+    # Leases are released when the cache is closed.
+    first.close()
+    assert second.acquire_lease(2)
+    second.close()
+
+
+n_slow_calls = 0
+slow_calls_lock = threading.Lock()
+
+@decorators.action_def
+def slow_count(a: int) -> int:
+    global n_slow_calls
+    with slow_calls_lock:
+        n_slow_calls += 1
+    time.sleep(0.05)
+    return 2 * a
+
+
+@decorators.analysis
+def make_slow_calls(self):
+    return [slow_count(i) for i in range(6)]
+
+
+def test_shared_cache():
+    # Concurrent evaluations sharing the cache directory, each with its own index connection.
+    cache_dir = make_cache_dir("shared")
+    results = []
+
+    def evaluate():
+        result_cache = cache.DiskResultCache(cache_dir)
+        resource = evaluation.Resource(cache=result_cache)
+        resource.poll_interval = 0.01
+        analysis = evaluation.Evaluation.make_analysis(make_slow_calls.action, [])
+        eval = evaluation.Evaluation(analysis, [resource])
+        results.append(eval.execute(wait_timeout=0.01).result)
+        result_cache.close()
+
+    threads = [threading.Thread(target=evaluate) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == 4 * [[0, 2, 4, 6, 8, 10]]
+    # Every task computed by a single evaluation.
+    assert n_slow_calls == 6
+
+
+@decorators.action_def
+def identity(a: int) -> int:
+    return a
+
+
+@decorators.analysis
+def make_repeated_slow_calls(self):
+    return [slow_count(1), slow_count(identity(1)), slow_count(identity(identity(1)))]
+
+
+def test_probe_miss_finished_meanwhile():
+    # Tasks probed while a task with the same hash runs take its result.
+    global n_slow_calls
+    n_slow_calls = 0
+    resource = evaluation.ThreadPoolResource(n_threads=1)
+    assert evaluation.run(make_repeated_slow_calls, resources=[resource]) == [2, 2, 2]
+    resource.close()
+    assert n_slow_calls == 1
+
+
+def test_probe():
+    result_cache = cache.DiskResultCache(make_cache_dir("probe"))
+    for i in range(10):
+        result_cache.insert(i, i, result_hash=100 + i)
+    queries = []
+    result_cache._db.set_trace_callback(lambda query: queries.append(query))
+    assert result_cache.probe(range(5, 1000)) == {i: 100 + i for i in range(5, 10)}
+    # The Bloom filter rejects almost all missing hashes before the query.
+    in_queries = [query for query in queries if " IN (" in query]
+    assert len(in_queries) == 1
+    assert in_queries[0].count("'") < 2 * 50
+    # Values inserted meanwhile are found.
+    result_cache.insert(1000, "new")
+    assert 1000 in result_cache.probe([1000, 1001])
+    result_cache.close()
+
+
+@decorators.analysis
+def make_more_calls(self):
+    return [count_calls(i) for i in range(6)]
+
+
+def test_evaluation_probe():
+    global n_calls
+    n_calls = 0
+    cache_dir = make_cache_dir("evaluation_probe")
+    result_cache = cache.DiskResultCache(cache_dir)
+    evaluation.run(make_calls, resources=[evaluation.Resource(cache=result_cache)])
+    result_cache.close()
+
+    result_cache = cache.DiskResultCache(cache_dir)
+    single_lookups = []
+    result_hash = result_cache.result_hash
+    result_cache.result_hash = lambda hash_int: single_lookups.append(hash_int) or result_hash(hash_int)
+    result = evaluation.run(make_more_calls, resources=[evaluation.Resource(cache=result_cache)])
+    assert result == [0, 2, 4, 6, 8, 10]
+    assert n_calls == 6
+    # Ready tasks are probed in batches, no lookups of single tasks.
+    assert single_lookups == []
+    result_cache.close()
+
+
+def test_garbage_collection():
+    cache_dir = make_cache_dir("gc")
+    result_cache = cache.DiskResultCache(cache_dir)
+    value = "x" * 1000
+    for hash_int, cost in [(1, 1.0), (2, 100.0), (3, 10.0), (4, 0.1)]:
+        result_cache.insert(hash_int, (hash_int, value), cost=cost)
+    result_cache.pin("keep", [4])
+    size = result_cache.n_bytes() // 4
+
+    # The cheapest unpinned value is removed first.
+    report = result_cache.collect_garbage(max_bytes=3 * size, dry_run=True)
+    assert (report.n_removed, report.n_bytes_removed, report.n_kept) == (1, size, 3)
+    assert len(result_cache) == 4
+    report = result_cache.collect_garbage(max_bytes=3 * size)
+    assert report.n_bytes_removed == size
+    assert 1 not in result_cache and result_cache.value(1) is cache.ResultCache.NoValue
+    assert result_cache.value(4) == (4, value)
+
+    # Values not used for a long time are removed.
+    result_cache._modify("UPDATE results SET accessed = 0 WHERE hash = ?", (result_cache._key(3),))
+    assert result_cache.collect_garbage(max_idle=3600).n_removed == 1
+    assert 3 not in result_cache
+    # Pinned values are kept regardless of the quota.
+    assert result_cache.collect_garbage(max_bytes=0).n_kept == 1
+    assert 4 in result_cache
+    result_cache.close()
+
+    cache_gc.main([cache_dir, "--max-bytes", "0", "--unpin", "keep"])
+    result_cache = cache.DiskResultCache(cache_dir)
+    assert len(result_cache) == 0
+    assert result_cache.pin_labels() == {}
+    result_cache.close()
+    assert cache_gc.parse_size("2k") == 2048
+    assert cache_gc.parse_duration("1.5h") == 5400
+
+
+def test_pinned_analysis():
+    cache_dir = make_cache_dir("pinned_analysis")
+    result_cache = cache.DiskResultCache(cache_dir, pin="calls")
+    evaluation.run(make_calls, resources=[evaluation.Resource(cache=result_cache)])
+    n_values = len(result_cache)
+    assert result_cache.pin_labels() == {"calls": n_values}
+    # Values of the pinned analysis are kept.
+    assert result_cache.collect_garbage(max_bytes=0).n_removed == 0
+    assert result_cache.collect_garbage(max_bytes=0, ignore_pins=["calls"]).n_removed == n_values
+    result_cache.close()
+
+
+def test_compression():
+    log = "\n".join("iteration {} residual {}".format(i, 1.0 / (i + 1)) for i in range(10000))
+    field = np.arange(100000, dtype=float)
+    for compression in ['zlib', 'lzma']:
+        cache_dir = make_cache_dir("compression_" + compression)
+        result_cache = cache.DiskResultCache(cache_dir, compression=compression)
+        result_cache.insert(1, dict(stdout=log))
+        result_cache.insert(2, "short")
+        result_cache.insert(3, dict(field=field, stdout=log))
+        codecs = dict(result_cache._db.execute("SELECT results.hash, codec FROM results "
+                                               "JOIN blobs ON blobs.hash = result_hash"))
+        assert codecs == {result_cache._key(1): compression, result_cache._key(2): None,
+                          result_cache._key(3): compression}
+        path = result_cache._value_path(result_cache._key(result_cache.result_hash(1)))
+        assert 3 * os.path.getsize(path) < len(log)
+        assert result_cache.value(1) == dict(stdout=log)
+        assert result_cache.value(2) == "short"
+        # Array buffers are stored raw and memory mapped.
+        loaded = result_cache.value(3)
+        assert isinstance(loaded['field'], np.memmap)
+        assert np.all(loaded['field'] == field)
+        assert loaded['stdout'] == log
+        result_cache.close()
+
+        # Compressed values are readable regardless of the codec of the cache.
+        result_cache = cache.DiskResultCache(cache_dir, compression=None)
+        assert result_cache.value(1) == dict(stdout=log)
+        result_cache.close()
+
+
+def test_deduplication():
+    result_cache = cache.DiskResultCache(make_cache_dir("deduplication"))
+    value = dict(template="x = {x}\n" * 1000, x=1)
+    for hash_int in range(3):
+        result_cache.insert(hash_int, value, cost=hash_int)
+    result_cache.insert(3, "other")
+    # Equal values stored once.
+    assert result_cache._query_one("SELECT COUNT(*) FROM blobs")[0] == 2
+    value_size = result_cache.n_bytes() - result_cache._query_one(
+        "SELECT size FROM blobs WHERE hash = ?", (result_cache._key(data.hash("other")),))[0]
+    assert all(result_cache.value(hash_int) == value for hash_int in range(3))
+
+    # Replaced result releases its value.
+    result_cache.insert(3, value)
+    assert result_cache.n_bytes() == value_size
+    # The space of a shared value is reclaimed with its last result.
+    report = result_cache.collect_garbage(max_bytes=value_size)
+    assert report.n_removed == 0
+    report = result_cache.collect_garbage(max_bytes=0)
+    assert (report.n_removed, report.n_bytes_removed) == (4, value_size)
+    assert result_cache.n_bytes() == 0
+    assert os.listdir(os.path.dirname(result_cache._value_path(result_cache._key(data.hash(value))))) == []
+    result_cache.close()